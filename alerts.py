@@ -0,0 +1,356 @@
+from collections import namedtuple, deque
+from flask_mail import Mail, Message
+from flask import render_template
+from serverpatrol import app
+from metrics import metrics
+from flask_babel import _
+from models import *
+import threading
+import heapq
+import click
+import queue
+import time
+
+
+mail = Mail(app) # Only set up by the processes sending alerts
+
+
+# What the alerts about a status change tell, copied from the monitoring so later checks don't alter it
+StatusChange = namedtuple('StatusChange', [
+    'name',
+    'url',
+    'status',
+    'last_down_reason',
+    'last_status_change_at',
+    'email_recipients',
+    'sms_recipients'
+])
+
+
+class Digest:
+    """Status changes to alert a recipient about, collected during the digest window."""
+    def __init__(self, channel, recipient):
+        self.channel = channel
+        self.recipient = recipient
+        self.changes = []
+
+
+def get_home_url():
+    """URL of the statuses page, built from the config since the flask commands sending the emails don't load the
+    routes."""
+    return '{}://{}{}/'.format(app.config['PREFERRED_URL_SCHEME'], app.config['SERVER_NAME'], app.config['APPLICATION_ROOT'].rstrip('/'))
+
+
+def render_email(recipient, changes):
+    message = Message(recipients=[recipient])
+    home_url = get_home_url()
+
+    down_count = sum(1 for change in changes if change.status == MonitoringStatus.DOWN)
+
+    if down_count:
+        message.extra_headers = {
+            'X-Priority': '1',
+            'X-MSMail-Priority': 'High',
+            'Importance': 'High'
+        }
+
+    if len(changes) == 1:
+        change = changes[0]
+
+        if change.status == MonitoringStatus.DOWN: # The new status is down?
+            message.subject = _('%(monitoring_name)s is gone', monitoring_name=change.name)
+        elif change.status == MonitoringStatus.UP: # The new status is up?
+            message.subject = _('%(monitoring_name)s is back up', monitoring_name=change.name)
+
+        message.body = render_template('emails/status_changed.txt', monitoring=change, home_url=home_url)
+        message.html = render_template('emails/status_changed.html', monitoring=change, home_url=home_url)
+    else:
+        message.subject = _('%(down_count)i monitoring(s) gone, %(up_count)i back up', down_count=down_count, up_count=len(changes) - down_count)
+        message.body = render_template('emails/digest.txt', changes=changes, home_url=home_url)
+        message.html = render_template('emails/digest.html', changes=changes, home_url=home_url)
+
+    return message
+
+
+def render_sms(changes):
+    if len(changes) == 1:
+        return render_template('sms/status_changed.txt', monitoring=changes[0])
+
+    return render_template('sms/digest.txt', changes=changes)
+
+
+class EmailAlert:
+    def __init__(self, message):
+        self.message = message
+        self.attempts = 0
+
+    def __str__(self):
+        return 'email to {}'.format(', '.join(self.message.recipients))
+
+
+class SmsAlert:
+    def __init__(self, recipient, body):
+        self.recipient = recipient
+        self.body = body
+        self.attempts = 0
+
+    def __str__(self):
+        return 'SMS to {}'.format(self.recipient)
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def take(self):
+        """Consume a token if one is available and return 0, otherwise return the number of seconds to wait until one
+        is."""
+        now = time.monotonic()
+
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+        if self.tokens >= 1:
+            self.tokens -= 1
+
+            return 0
+
+        return (1 - self.tokens) / self.rate
+
+
+class AlertDispatcher:
+    """Send the alerts from a background thread so the checks are never slowed down by them.
+
+    The status changes reported to each recipient during digest_window seconds (from the first one) are sent to them
+    in a single email or SMS, so an outage affecting many monitorings at once sends one message per recipient instead
+    of one per monitoring. Pending digests are sent right away when the dispatcher is closed.
+
+    Emails which are ready at the same time are sent through a single SMTP connection. SMS are rate-limited using a
+    token bucket. Failed alerts are retried with an exponential backoff."""
+    def __init__(self, max_retries, retry_delay, sms_per_second, sms_burst, digest_window=0):
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.sms_bucket = TokenBucket(sms_per_second, sms_burst)
+        self.digest_window = digest_window
+
+        self.queue = queue.Queue()
+        self.pending = [] # Heap of (due time, sequence, alert or Digest)
+        self.digests = {} # (channel, recipient) => Digest being collected
+        self.sequence = 0
+        self.sms_queue = deque() # SMS waiting for the rate limiter
+        self.sms_wakeup = None
+        self.closing = False
+        self.twilio_client = None
+        self.thread = threading.Thread(target=self.run, name='alerts', daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def send_email(self, message):
+        self.queue.put(EmailAlert(message))
+
+    def send_sms(self, recipient, body):
+        self.queue.put(SmsAlert(recipient, body))
+
+    def send_status_change(self, change):
+        """Alert the recipients of a StatusChange, in their next digest."""
+        self.queue.put(change)
+
+    def close(self):
+        """Wait for all the alerts to be sent (or to definitely fail) then stop the thread."""
+        if not self.thread.is_alive():
+            return
+
+        self.queue.put(None)
+        self.thread.join()
+
+    def run(self):
+        with app.app_context():
+            while not self.closing or self.pending or self.sms_queue:
+                self.receive()
+
+                due = []
+
+                while self.pending and self.pending[0][0] <= time.monotonic():
+                    alert = heapq.heappop(self.pending)[2]
+
+                    if isinstance(alert, Digest):
+                        alert = self.render_digest(alert)
+
+                    if alert:
+                        due.append(alert)
+
+                self.send_emails([alert for alert in due if isinstance(alert, EmailAlert)])
+
+                self.sms_queue.extend([alert for alert in due if isinstance(alert, SmsAlert)])
+
+                self.send_queued_sms()
+
+    def receive(self):
+        """Move the new alerts to the pending heap, waiting for them until the next pending one is due."""
+        wakeups = [self.pending[0][0]] if self.pending else []
+
+        if self.sms_queue:
+            wakeups.append(self.sms_wakeup)
+
+        timeout = max(0, min(wakeups) - time.monotonic()) if wakeups else None
+
+        if self.closing:
+            if timeout:
+                time.sleep(timeout)
+
+            return
+
+        try:
+            alert = self.queue.get(timeout=timeout)
+
+            while True:
+                if alert is None:
+                    self.closing = True
+
+                    self.flush_digests()
+
+                    break
+
+                if isinstance(alert, StatusChange):
+                    self.collect(alert)
+                else:
+                    self.schedule(alert)
+
+                alert = self.queue.get_nowait()
+        except queue.Empty:
+            pass
+
+    def schedule(self, alert, delay=0):
+        self.sequence += 1
+
+        heapq.heappush(self.pending, (time.monotonic() + delay, self.sequence, alert))
+
+    def collect(self, change):
+        """Add a status change to the digest of each one of its recipients, starting the digests not started yet."""
+        recipients = [('email', recipient) for recipient in change.email_recipients] + [('sms', recipient) for recipient in change.sms_recipients]
+
+        for key in recipients:
+            digest = self.digests.get(key)
+
+            if not digest:
+                digest = self.digests[key] = Digest(*key)
+
+                self.schedule(digest, self.digest_window)
+
+            digest.changes.append(change)
+
+    def flush_digests(self):
+        """Make the digests being collected due now."""
+        now = time.monotonic()
+
+        self.pending = [
+            (min(due_at, now) if isinstance(alert, Digest) else due_at, sequence, alert) for due_at, sequence, alert in self.pending
+        ]
+
+        heapq.heapify(self.pending)
+
+    def render_digest(self, digest):
+        """Return the EmailAlert or SmsAlert of a complete digest."""
+        del self.digests[(digest.channel, digest.recipient)]
+
+        try:
+            if digest.channel == 'email':
+                return EmailAlert(render_email(digest.recipient, digest.changes))
+
+            return SmsAlert(digest.recipient, render_sms(digest.changes))
+        except Exception as e: # Don't let a template error stop the thread
+            metrics.inc('serverpatrol_alerts_total', channel=digest.channel, outcome='failed')
+
+            click.echo('Error rendering the {} to {}: {}'.format(digest.channel, digest.recipient, e), err=True)
+            app.logger.error('Error rendering the {} to {}: {}'.format(digest.channel, digest.recipient, e))
+
+            return None
+
+    def retry(self, alerts, error):
+        """Retry alerts of the same channel which failed together. They are retried as a unit: they share their number
+        of attempts, and are due at the same time again so the emails are sent through a single connection."""
+        attempts = max(alert.attempts for alert in alerts) + 1
+        channel = 'email' if isinstance(alerts[0], EmailAlert) else 'sms'
+        description = ', '.join(str(alert) for alert in alerts)
+
+        if attempts > self.max_retries:
+            metrics.inc('serverpatrol_alerts_total', len(alerts), channel=channel, outcome='failed')
+
+            click.echo('Error sending {}, giving up: {}'.format(description, error), err=True)
+            app.logger.error('Error sending {}, giving up: {}'.format(description, error))
+
+            return
+
+        delay = self.retry_delay * 2 ** (attempts - 1)
+
+        metrics.inc('serverpatrol_alerts_total', len(alerts), channel=channel, outcome='retried')
+
+        click.echo('Error sending {}, retrying in {}s: {}'.format(description, delay, error), err=True)
+
+        for alert in alerts:
+            alert.attempts = attempts
+
+            self.schedule(alert, delay)
+
+    def send_emails(self, alerts):
+        while alerts:
+            connected = False
+
+            try:
+                with mail.connect() as connection:
+                    connected = True
+
+                    while alerts:
+                        with metrics.time('serverpatrol_alert_send_duration_seconds', channel='email'):
+                            connection.send(alerts[0].message)
+
+                        metrics.inc('serverpatrol_alerts_total', channel='email', outcome='sent')
+
+                        click.echo('Sent {}'.format(alerts.pop(0)))
+            except Exception as e:
+                if not connected: # The SMTP server is unreachable: the other emails would fail the same way
+                    self.retry(alerts, e)
+
+                    return
+
+                if alerts: # The connection may be unusable: reconnect to send the other ones
+                    self.retry([alerts.pop(0)], e)
+
+    def send_queued_sms(self):
+        while self.sms_queue:
+            wait = self.sms_bucket.take()
+
+            if wait:
+                self.sms_wakeup = time.monotonic() + wait
+
+                return
+
+            alert = self.sms_queue.popleft()
+
+            try:
+                if not self.twilio_client:
+                    import twilio.rest # Only loaded if SMS are actually sent
+
+                    self.twilio_client = twilio.rest.Client(app.config['TWILIO_ACCOUNT_SID'], app.config['TWILIO_AUTH_TOKEN'])
+
+                with metrics.time('serverpatrol_alert_send_duration_seconds', channel='sms'):
+                    self.twilio_client.messages.create(
+                        to=alert.recipient,
+                        from_=app.config['TWILIO_SENDER_PHONE_NUMBER'],
+                        body=alert.body
+                    )
+
+                metrics.inc('serverpatrol_alerts_total', channel='sms', outcome='sent')
+
+                click.echo('Sent {}'.format(alert))
+            except Exception as e:
+                self.retry([alert], e)
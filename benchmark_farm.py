@@ -0,0 +1,187 @@
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import multiprocessing
+import socketserver
+import threading
+import random
+import time
+import ssl
+
+LARGE_BODY_END = b'end-of-large-body'
+
+
+class FarmRequestHandler(BaseHTTPRequestHandler):
+    """Answer like a server with the latency, error rate and timeout rate given in settings. /large returns a body of
+    settings['body_size'] bytes ending with LARGE_BODY_END."""
+    protocol_version = 'HTTP/1.1' # Keep-alive
+    settings = {}
+
+    def do_GET(self):
+        latency = self.settings['latency'] / 1000
+        draw = random.random()
+
+        if draw < self.settings['timeout_rate']:
+            time.sleep(self.settings['timeout'] + 0.5)
+        elif latency:
+            time.sleep(random.uniform(latency / 2, latency * 1.5))
+
+        status = 500 if draw > 1 - self.settings['error_rate'] else 200
+
+        if self.path == '/large':
+            body = b'a' * max(0, self.settings['body_size'] - len(LARGE_BODY_END)) + LARGE_BODY_END
+        else:
+            body = b'Hello from the benchmark farm'
+
+        try:
+            self.send_response(status)
+            self.send_header('Content-Type', 'text/plain; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except OSError: # The checker gave up (timeout)
+            pass
+
+    do_HEAD = do_GET
+    do_POST = do_GET
+
+    def log_message(self, format, *args):
+        pass
+
+
+def run_farm(hosts, settings, certificate, addresses):
+    """Start hosts HTTP(S) servers listening on random ports, put the list of their (address, port) in the addresses
+    queue then serve forever. Meant to be run in a separate process so it doesn't skew the measures of the checker.
+
+    Each server listens on its own loopback address when possible (127.0.0.1, 127.0.0.2, ...), so the checker sees as
+    many different hosts."""
+    FarmRequestHandler.settings = settings
+
+    servers = []
+
+    for i in range(hosts):
+        try:
+            server = ThreadingHTTPServer(('127.0.{}.{}'.format(i // 254, i % 254 + 1), 0), FarmRequestHandler)
+        except OSError: # Only 127.0.0.1 is available (e.g on macOS)
+            server = ThreadingHTTPServer(('127.0.0.1', 0), FarmRequestHandler)
+
+        server.daemon_threads = True
+
+        if certificate:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(*certificate)
+
+            server.socket = context.wrap_socket(server.socket, server_side=True)
+
+        servers.append(server)
+
+    addresses.put([server.server_address for server in servers])
+
+    for server in servers[1:]:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    servers[0].serve_forever()
+
+
+class Farm:
+    def __init__(self, hosts, settings, certificate=None):
+        addresses = multiprocessing.Queue()
+
+        self.process = multiprocessing.Process(target=run_farm, args=(hosts, settings, certificate, addresses), daemon=True)
+        self.process.start()
+
+        self.addresses = addresses.get(timeout=30)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.process.terminate()
+        self.process.join()
+
+
+class Sink:
+    """Count the messages received, and the time spent receiving them."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.count = 0
+        self.first_at = None
+        self.last_at = None
+
+    def record(self):
+        with self.lock:
+            now = time.perf_counter()
+
+            self.count += 1
+            self.first_at = self.first_at or now
+            self.last_at = now
+
+    def to_dict(self):
+        duration = self.last_at - self.first_at if self.count > 1 else None
+
+        return {
+            'count': self.count,
+            'duration': duration,
+            'per_second': (self.count - 1) / duration if duration else None
+        }
+
+
+class SmtpRequestHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        self.reply('220 localhost Benchmark SMTP sink')
+
+        while True:
+            line = self.rfile.readline()
+
+            if not line:
+                return
+
+            command = line[:4].upper()
+
+            if command == b'EHLO':
+                self.reply('250-localhost')
+                self.reply('250 8BITMIME')
+            elif command == b'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+
+                while self.rfile.readline() not in (b'.\r\n', b''):
+                    pass
+
+                self.server.sink.record()
+
+                self.reply('250 OK')
+            elif command == b'QUIT':
+                self.reply('221 Bye')
+
+                return
+            else: # HELO, MAIL, RCPT, RSET, NOOP
+                self.reply('250 OK')
+
+
+class SmtpSink(Sink):
+    """SMTP server accepting and discarding every message."""
+    def __init__(self):
+        super().__init__()
+
+        self.server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), SmtpRequestHandler)
+        self.server.daemon_threads = True
+        self.server.sink = self
+        self.port = self.server.server_address[1]
+
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class TwilioSink(Sink):
+    """Stand-in for twilio.rest.Client, discarding every message."""
+    def __init__(self):
+        super().__init__()
+
+        self.messages = self
+
+    def create(self, to, from_, body):
+        self.record()
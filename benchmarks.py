@@ -0,0 +1,415 @@
+from commands import create_check_engine, create_alert_dispatcher, check_monitorings
+from sqlalchemy.orm import Session, scoped_session, sessionmaker
+from contextlib import contextmanager, redirect_stdout
+from benchmark_farm import Farm, SmtpSink, TwilioSink
+from checker import get_dispatch_delays
+from sqlalchemy import create_engine
+from collections import OrderedDict
+from serverpatrol import app, db
+from leases import LeaseManager
+from metrics import PhaseTimer
+from models import *
+import subprocess
+import statistics
+import platform
+import tempfile
+import urllib3
+import models
+import click
+import arrow
+import json
+import time
+import sys
+import os
+
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+
+@app.cli.group()
+def benchmark():
+    """Measure Server Patrol's performances."""
+    pass
+
+
+def create_benchmark_database(path, monitorings_count, wal):
+    engine = create_engine('sqlite:///' + path)
+
+    with engine.connect() as connection:
+        connection.exec_driver_sql('PRAGMA journal_mode={}'.format('WAL' if wal else 'DELETE'))
+
+    Monitoring.__table__.create(engine)
+    Check.__table__.create(engine)
+
+    with Session(bind=engine) as session:
+        session.bulk_insert_mappings(Monitoring, [
+            {
+                'name': 'Monitoring {}'.format(i),
+                'is_active': True,
+                'url': 'http://localhost/{}'.format(i),
+                'http_headers': {},
+                'email_recipients': [],
+                'sms_recipients': [],
+                'status': MonitoringStatus.UP
+            } for i in range(monitorings_count)
+        ])
+
+        session.commit()
+
+    return engine
+
+
+def update_monitorings(session, commit_every):
+    now = arrow.now()
+    monitorings = []
+    checks = []
+
+    for i, (monitoring_id, status) in enumerate(session.query(Monitoring.id, Monitoring.status), start=1):
+        status = MonitoringStatus.DOWN if status == MonitoringStatus.UP else MonitoringStatus.UP
+
+        monitorings.append({
+            'id': monitoring_id,
+            'status': status,
+            'last_checked_at': now,
+            'next_check_at': now.shift(minutes=5)
+        })
+
+        checks.append({
+            'monitoring_id': monitoring_id,
+            'date_time': now,
+            'status': status,
+            'http_status_code': 200,
+            'request_duration': 100
+        })
+
+        if commit_every and i % commit_every == 0:
+            save(session, monitorings, checks)
+
+            monitorings = []
+            checks = []
+
+    save(session, monitorings, checks)
+
+
+def save(session, monitorings, checks):
+    session.bulk_update_mappings(Monitoring, monitorings) # Like history.save_checks() does
+    session.bulk_insert_mappings(Check, checks)
+    session.commit()
+
+
+@benchmark.command()
+@click.option('--counts', default='10,100,1000,5000', help='Comma-separated numbers of monitorings to benchmark with')
+@click.option('--batch-size', default=500, help='Number of monitorings per transaction for the batched strategy')
+@click.option('--wal', is_flag=True, default=False, help='Put the benchmark database in WAL mode')
+def commits(counts, batch_size, wal):
+    """Compare the time spent saving a tick's results: one transaction per monitoring vs batched transactions."""
+    strategies = [
+        ('per monitoring', 1),
+        ('batches of {}'.format(batch_size), batch_size),
+        ('single', 0)
+    ]
+
+    click.echo('{:>12} {:>20} {:>12} {:>20}'.format('monitorings', 'transactions', 'total (s)', 'per monitoring (ms)'))
+
+    for monitorings_count in [int(count) for count in counts.split(',')]:
+        for strategy_name, commit_every in strategies:
+            with tempfile.TemporaryDirectory() as directory:
+                engine = create_benchmark_database(os.path.join(directory, 'benchmark.sqlite'), monitorings_count, wal)
+
+                with Session(bind=engine) as session:
+                    start = time.perf_counter()
+
+                    update_monitorings(session, commit_every)
+
+                    duration = time.perf_counter() - start
+
+                engine.dispose()
+
+            click.echo('{:>12} {:>20} {:>12.3f} {:>20.3f}'.format(monitorings_count, strategy_name, duration, duration / monitorings_count * 1000))
+
+
+@contextmanager
+def benchmark_session(path):
+    """Make db.session use a new, empty database while in this context, so the benchmarks can run the real code. The
+    files signaling changes to the web app and the patrol daemon are written next to it instead of in storage/."""
+    engine = create_engine('sqlite:///' + path)
+    original_session = db.session
+    original_changed_files = (models.MONITORINGS_CHANGED_FILE, models.STATUSES_CHANGED_FILE)
+
+    db.Model.metadata.create_all(engine)
+
+    db.session = scoped_session(sessionmaker(bind=engine))
+
+    directory = os.path.dirname(path)
+
+    models.MONITORINGS_CHANGED_FILE = os.path.join(directory, '.monitorings_changed')
+    models.STATUSES_CHANGED_FILE = os.path.join(directory, '.statuses_changed')
+
+    try:
+        yield
+    finally:
+        db.session.remove()
+
+        db.session = original_session
+        models.MONITORINGS_CHANGED_FILE, models.STATUSES_CHANGED_FILE = original_changed_files
+
+        engine.dispose()
+
+
+def create_certificate(directory):
+    """Create a self-signed certificate for the HTTPS farm using the openssl command. Return (certificate, key) paths."""
+    certificate = os.path.join(directory, 'farm.crt')
+    key = os.path.join(directory, 'farm.key')
+
+    try:
+        subprocess.run([
+            'openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1', '-subj', '/CN=localhost',
+            '-keyout', key, '-out', certificate
+        ], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError) as e:
+        raise click.UsageError('Unable to create a certificate using openssl, required by --tls: {}'.format(e))
+
+    return certificate, key
+
+
+def seed_monitorings(count, addresses, scheme, timeout, large_body_rate, email_recipients, sms_recipients):
+    now = arrow.now()
+    large_body_every = round(1 / large_body_rate) if large_body_rate else None
+
+    db.session.bulk_insert_mappings(Monitoring, [
+        {
+            'name': 'Monitoring {}'.format(i),
+            'is_active': True,
+            'is_public': True,
+            'url': '{}://{}:{}/{}'.format(scheme, *addresses[i % len(addresses)], 'large' if large_body_every and i % large_body_every == 0 else i),
+            'http_method': MonitoringHttpMethod.GET,
+            'http_headers': {},
+            'http_body_regex': '(?s).*end-of-large-body' if large_body_every and i % large_body_every == 0 else None,
+            'verify_https_cert': False,
+            'check_interval': 1,
+            'timeout': timeout,
+            'email_recipients': ['monitoring{}-{}@localhost'.format(i, j) for j in range(email_recipients)],
+            'sms_recipients': ['+3360000{:04d}'.format(j) for j in range(sms_recipients)],
+            'status': MonitoringStatus.UP, # So the failures send alerts right from the first tick
+            'created_at': now,
+            'next_check_at': now
+        } for i in range(count)
+    ])
+
+    db.session.commit()
+
+
+def run_tick(engine, alerts, leases):
+    """Check all the monitorings, the same way flask check --force does, and measure how long each phase takes."""
+    start = time.perf_counter()
+    timer = PhaseTimer()
+
+    with timer.phase('query'):
+        monitorings = leases.claim(Monitoring.query.get_for_checking(), arrow.now())
+
+    delays = get_dispatch_delays(monitorings, time.time(), app.config['CHECKS_MAX_PER_SECOND'], ignore_due=True)
+
+    check_monitorings(monitorings, engine, alerts, timer, delays)
+
+    wall_time = time.perf_counter() - start
+
+    return {
+        'checks': len(monitorings),
+        'down': sum(1 for monitoring in monitorings if monitoring.status == MonitoringStatus.DOWN),
+        'wall_time': wall_time,
+        'checks_per_second': len(monitorings) / wall_time,
+        'query_time': timer.durations.get('query', 0),
+        'commit_time': timer.durations.get('commit', 0),
+        'phases': timer.durations
+    }
+
+
+def get_peak_rss():
+    """Peak resident set size of this process, in KiB."""
+    if not resource:
+        return None
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return peak_rss // 1024 if sys.platform == 'darwin' else peak_rss # Bytes on macOS
+
+
+# Entry point => code loading it like the web server or the flask command do
+STARTUP_ENTRY_POINTS = OrderedDict([
+    ('web', 'import web'),
+    ('checker', 'import serverpatrol; serverpatrol.app.cli.get_command(None, "check")')
+])
+
+# Dependencies whose loading is reported
+STARTUP_HEAVY_MODULES = ('requests', 'twilio.rest', 'flask_mail', 'wtforms', 'routes', 'checker')
+
+STARTUP_SCRIPT = """
+import time
+start = time.perf_counter()
+{code}
+duration = time.perf_counter() - start
+import json, sys
+try:
+    import resource
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // (1024 if sys.platform == 'darwin' else 1)
+except ImportError:
+    peak_rss = None
+print(json.dumps({{'duration': duration, 'peak_rss_kib': peak_rss, 'modules': sorted(sys.modules)}}))
+"""
+
+
+def measure_startup(code):
+    """Load an entry point in a new Python process. Return the time spent importing it, the process total time, its
+    peak RSS and the modules it loaded."""
+    start = time.perf_counter()
+
+    process = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT.format(code=code)], cwd=app.root_path, stdout=subprocess.PIPE, check=True)
+
+    result = json.loads(process.stdout.decode('utf-8').splitlines()[-1])
+    result['process_duration'] = time.perf_counter() - start
+
+    return result
+
+
+@benchmark.command()
+@click.option('--runs', default=5, help='Number of times each entry point is loaded')
+@click.option('--output', type=click.File('w'), default='-', help='File to write the results to, as JSON (defaults to the standard output)')
+def startup(runs, output):
+    """Measure the cold start of the web app (web.py) and of the flask commands (serverpatrol.py), each in a new Python
+    process: import time, total time, peak memory usage and heavy dependencies loaded. Medians are reported."""
+    results = OrderedDict()
+
+    for name, code in STARTUP_ENTRY_POINTS.items():
+        measures = []
+
+        for i in range(runs):
+            measures.append(measure_startup(code))
+
+            click.echo('{} {}/{}: {:.3f}s'.format(name, i + 1, runs, measures[-1]['duration']), err=True)
+
+        modules = measures[-1]['modules']
+
+        results[name] = {
+            'import_duration': statistics.median([measure['duration'] for measure in measures]),
+            'process_duration': statistics.median([measure['process_duration'] for measure in measures]),
+            'peak_rss_kib': statistics.median([measure['peak_rss_kib'] for measure in measures]) if measures[-1]['peak_rss_kib'] else None,
+            'modules_count': len(modules),
+            'heavy_modules': [module for module in STARTUP_HEAVY_MODULES if module in modules]
+        }
+
+    json.dump({
+        'date': arrow.now().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'runs': runs,
+        'entry_points': results
+    }, output, indent=2)
+
+    output.write('\n')
+
+
+@benchmark.command()
+@click.option('--monitorings', 'monitorings_count', default=1000, help='Number of monitorings to check')
+@click.option('--ticks', default=3, help='Number of times all the monitorings are checked')
+@click.option('--hosts', default=10, help='Number of fake servers the monitorings are spread across')
+@click.option('--latency', default=50, help='Average response time of the fake servers, in milliseconds')
+@click.option('--error-rate', default=0.05, help='Ratio of responses with a 500 HTTP status code')
+@click.option('--timeout-rate', default=0.01, help='Ratio of requests timing out')
+@click.option('--timeout', default=2, help='Timeout of the monitorings, in seconds')
+@click.option('--large-body-rate', default=0.01, help='Ratio of monitorings with a response body Regex check against a large body')
+@click.option('--body-size', default=1024 * 1024, help='Size of the large bodies, in bytes')
+@click.option('--tls', is_flag=True, default=False, help='Serve the fake servers over HTTPS (requires the openssl command)')
+@click.option('--email-recipients', default=1, help='Number of email recipients per monitoring')
+@click.option('--sms-recipients', default=0, help='Number of SMS recipients per monitoring')
+@click.option('--output', type=click.File('w'), default='-', help='File to write the results to, as JSON (defaults to the standard output)')
+def tick(monitorings_count, ticks, hosts, latency, error_rate, timeout_rate, timeout, large_body_rate, body_size, tls, email_recipients, sms_recipients, output):
+    """Check monitorings against a local farm of fake servers, and measure the time taken by each tick along with the
+    alerts throughput (sent to fake SMTP and Twilio sinks)."""
+    parameters = {
+        'monitorings': monitorings_count,
+        'ticks': ticks,
+        'hosts': hosts,
+        'latency': latency,
+        'error_rate': error_rate,
+        'timeout_rate': timeout_rate,
+        'timeout': timeout,
+        'large_body_rate': large_body_rate,
+        'body_size': body_size,
+        'tls': tls,
+        'email_recipients': email_recipients,
+        'sms_recipients': sms_recipients,
+        'max_workers': app.config['CHECKS_MAX_WORKERS'],
+        'max_workers_per_host': app.config['CHECKS_MAX_WORKERS_PER_HOST'],
+        'commit_batch_size': app.config['CHECKS_COMMIT_BATCH_SIZE'],
+        'sqlite_wal': app.config['SQLITE_WAL']
+    }
+
+    farm_settings = {
+        'latency': latency,
+        'error_rate': error_rate,
+        'timeout_rate': timeout_rate,
+        'timeout': timeout,
+        'body_size': body_size
+    }
+
+    smtp_sink = SmtpSink()
+    twilio_sink = TwilioSink()
+
+    mail_state = app.extensions['mail']
+    mail_state.server = '127.0.0.1'
+    mail_state.port = smtp_sink.port
+    mail_state.use_tls = mail_state.use_ssl = False
+    mail_state.username = mail_state.password = None
+    mail_state.default_sender = mail_state.default_sender or ('Server Patrol', 'benchmark@localhost')
+
+    app.config.update(ENABLE_EMAIL_ALERTS=True, ENABLE_SMS_ALERTS=True, TWILIO_SENDER_PHONE_NUMBER='+33600000000')
+
+    results = []
+
+    with tempfile.TemporaryDirectory() as directory:
+        certificate = None
+
+        if tls:
+            certificate = create_certificate(directory)
+
+            urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning) # The certificate is self-signed
+
+        with Farm(hosts, farm_settings, certificate) as farm, benchmark_session(os.path.join(directory, 'benchmark.sqlite')):
+            seed_monitorings(monitorings_count, farm.addresses, 'https' if tls else 'http', timeout, large_body_rate, email_recipients, sms_recipients)
+
+            leases = LeaseManager(app.config['CHECKS_LEASE_DURATION'])
+
+            with open(os.devnull, 'w') as devnull, redirect_stdout(devnull): # The checker is quite verbose
+                with create_check_engine() as engine, create_alert_dispatcher() as alerts:
+                    alerts.twilio_client = twilio_sink
+
+                    for i in range(ticks):
+                        results.append(run_tick(engine, alerts, leases))
+
+                        click.echo('Tick {}/{}: {:.3f}s'.format(i + 1, ticks, results[-1]['wall_time']), err=True)
+
+                    click.echo('Waiting for the alerts to be sent', err=True)
+
+                    drain_start = time.perf_counter()
+
+            drain_time = time.perf_counter() - drain_start
+
+    smtp_sink.close()
+
+    json.dump({
+        'date': arrow.now().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': parameters,
+        'ticks': results,
+        'peak_rss_kib': get_peak_rss(),
+        'alerts': {
+            'emails': smtp_sink.to_dict(),
+            'sms': twilio_sink.to_dict(),
+            'drain_time': drain_time # Time needed to send the remaining alerts after the last tick
+        }
+    }, output, indent=2)
+
+    output.write('\n')
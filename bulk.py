@@ -0,0 +1,315 @@
+from werkzeug.datastructures import MultiDict
+from itertools import islice
+from serverpatrol import db
+from models import *
+import json
+import csv
+import io
+
+
+IMPORT_BATCH_SIZE = 500 # Number of rows saved in the same transaction
+EXPORT_BATCH_SIZE = 500
+
+FORMATS = ('jsonl', 'csv')
+
+MIMETYPES = {
+    'jsonl': 'application/x-ndjson',
+    'csv': 'text/csv'
+}
+
+# Columns of the monitorings which are exported and imported: the fields of MonitoringForm
+COLUMNS = (
+    'name',
+    'url',
+    'is_active',
+    'is_public',
+    'http_method',
+    'http_headers',
+    'http_body_regex',
+    'http_body_max_bytes',
+    'verify_https_cert',
+    'ignore_http_errors',
+    'check_interval',
+    'down_check_interval',
+    'timeout',
+    'down_confirmations',
+    'up_confirmations',
+    'retries',
+    'email_recipients',
+    'sms_recipients'
+)
+
+BOOLEAN_COLUMNS = ('is_active', 'is_public', 'verify_https_cert', 'ignore_http_errors')
+JSON_COLUMNS = ('http_headers', 'email_recipients', 'sms_recipients')
+
+TRUE_VALUES = ('true', '1', 'yes', 'y', 'on')
+FALSE_VALUES = ('false', '0', 'no', 'n', 'off', '')
+
+
+def get_format(filename, default='jsonl'):
+    """Guess the format of a file from its extension."""
+    if filename and filename.lower().endswith('.csv'):
+        return 'csv'
+
+    return default
+
+
+def get_row(values):
+    """Row of the given column values, with JSON-compatible types."""
+    return {
+        column: getattr(value, 'value', value) if column == 'http_method' else value for column, value in zip(COLUMNS, values)
+    }
+
+
+def format_csv_value(column, value):
+    if value is None:
+        return ''
+    elif column in BOOLEAN_COLUMNS:
+        return 'true' if value else 'false'
+    elif column in JSON_COLUMNS:
+        return json.dumps(value)
+
+    return value
+
+
+def export_monitorings(format):
+    """Yield all the monitorings, sorted by name, in the given format, by chunks of EXPORT_BATCH_SIZE lines. The
+    monitorings are loaded by batches as well, so memory usage doesn't depend on their number."""
+    q = Monitoring.query.with_entities(
+        *[getattr(Monitoring, column) for column in COLUMNS]
+    ).order_by(Monitoring.name.asc()).yield_per(EXPORT_BATCH_SIZE)
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+
+    if format == 'csv':
+        writer.writerow(COLUMNS)
+
+    for i, values in enumerate(q, start=1):
+        row = get_row(values)
+
+        if format == 'csv':
+            writer.writerow([format_csv_value(column, row[column]) for column in COLUMNS])
+        else:
+            buffer.write(json.dumps(row) + '\n')
+
+        if i % EXPORT_BATCH_SIZE == 0:
+            yield buffer.getvalue()
+
+            buffer.seek(0)
+            buffer.truncate()
+
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def read_rows(stream, format):
+    """Yield (line number, row) tuples from a text stream in the given format. Rows which can't be parsed are yielded
+    as a ValueError instead."""
+    if format == 'csv':
+        reader = csv.DictReader(stream)
+
+        for row in reader:
+            if None in row: # More values than columns
+                yield reader.line_num, ValueError('Too many values.')
+            else:
+                yield reader.line_num, row
+    else:
+        for line_number, line in enumerate(stream, start=1):
+            if not line.strip():
+                continue
+
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                yield line_number, ValueError('Invalid JSON: {}'.format(e))
+
+                continue
+
+            if not isinstance(row, dict):
+                yield line_number, ValueError('Not a JSON object.')
+            else:
+                yield line_number, row
+
+
+def get_form_value(column, value):
+    """Convert a value from a JSON Lines or CSV row to what an HTML form would submit. Return None if the field would
+    be missing from the submitted data."""
+    if column in BOOLEAN_COLUMNS:
+        if isinstance(value, str):
+            if value.strip().lower() in TRUE_VALUES:
+                value = True
+            elif value.strip().lower() in FALSE_VALUES:
+                value = False
+            else:
+                raise ValueError('Invalid boolean: {}'.format(value))
+
+        return 'y' if value else None # Unchecked checkboxes aren't submitted
+    elif value is None:
+        return ''
+    elif column in JSON_COLUMNS and not isinstance(value, str):
+        return json.dumps(value)
+
+    return str(value)
+
+
+def get_default_row():
+    """Row of the default values of MonitoringForm."""
+    from forms import MonitoringForm # WTForms is only loaded when importing
+
+    form = MonitoringForm(formdata=None, meta={'csrf': False})
+
+    return {column: form[column].data for column in COLUMNS}
+
+
+def validate_row(form, row, base_row):
+    """Validate a row using the given MonitoringForm, the missing columns being taken from base_row (the current
+    monitoring, or the default values). Return the errors (a dict), if any."""
+    unknown_columns = set(row) - set(COLUMNS)
+
+    if unknown_columns:
+        return {'columns': ['Unknown column(s): {}'.format(', '.join(sorted(unknown_columns)))]}
+
+    row = dict(base_row, **row)
+
+    formdata = MultiDict()
+
+    try:
+        for column, value in row.items():
+            value = get_form_value(column, value)
+
+            if value is not None:
+                formdata[column] = value
+    except ValueError as e:
+        return {column: [str(e)]}
+
+    form.process(formdata)
+
+    if not form.validate():
+        return {field: [str(message) for message in messages] for field, messages in form.errors.items()}
+
+    return None
+
+
+def get_form_row(form):
+    """Row of the values of a validated MonitoringForm, comparable to the row of a monitoring (see is_same_row())."""
+    row = get_row([form[column].data for column in COLUMNS])
+
+    for column in JSON_COLUMNS:
+        row[column] = json.loads(row[column]) if row[column] else None
+
+    return row
+
+
+def is_same_row(row, other):
+    """Whether two rows hold the same values, empty strings, documents and None being the same."""
+    def normalize(value):
+        return None if value in ('', None) or value == {} or value == [] else value
+
+    return all(normalize(row[column]) == normalize(other[column]) for column in COLUMNS)
+
+
+def import_monitorings(rows, dry_run=False, on_error=None):
+    """Create the monitorings from the given (line number, row) tuples (see read_rows()), or update them if one with
+    the same name already exists. Rows are validated then saved by batches of IMPORT_BATCH_SIZE, each batch in its own
+    transaction, so memory usage doesn't depend on the number of rows.
+
+    Rows which wouldn't change their monitoring are skipped. Invalid rows are skipped and reported to on_error(line
+    number, errors) if given. Nothing is saved if dry_run is True, but the rows are counted the same way, which requires
+    keeping all the valid rows in memory. Return the number of created, updated, unchanged and invalid rows."""
+    from forms import MonitoringForm # WTForms is only loaded when importing
+
+    counts = {'created': 0, 'updated': 0, 'unchanged': 0, 'invalid': 0}
+    form = MonitoringForm(formdata=None, meta={'csrf': False}) # Reused for every row, which is much faster
+    default_row = get_default_row()
+    imported = {} # Name => row of the monitorings created or updated by the previous rows
+    rows = iter(rows)
+
+    while True:
+        batch = list(islice(rows, IMPORT_BATCH_SIZE))
+
+        if not batch:
+            break
+
+        names = {row.get('name') for _, row in batch if isinstance(row, dict) and isinstance(row.get('name'), str)}
+        existing = {monitoring.name: monitoring for monitoring in Monitoring.query.filter(Monitoring.name.in_(names))}
+        changed = []
+
+        if not dry_run: # The monitorings of the previous batches are in the database: no need to remember them
+            imported = {}
+
+        for line_number, row in batch:
+            base_row = None
+
+            if isinstance(row, ValueError):
+                errors = {'line': [str(row)]}
+            else:
+                monitoring = existing.get(row.get('name'))
+
+                if row.get('name') in imported:
+                    base_row = imported[row.get('name')]
+                elif monitoring:
+                    base_row = get_row([getattr(monitoring, column) for column in COLUMNS])
+
+                errors = validate_row(form, row, base_row or default_row)
+
+            if errors:
+                counts['invalid'] += 1
+
+                if on_error:
+                    on_error(line_number, errors)
+
+                continue
+
+            form_row = get_form_row(form)
+
+            if base_row and is_same_row(form_row, base_row):
+                counts['unchanged'] += 1
+
+                continue
+
+            counts['updated' if base_row else 'created'] += 1
+            imported[form_row['name']] = form_row # Updated by the next rows with the same name, if any
+
+            if dry_run:
+                continue
+
+            if not monitoring:
+                monitoring = Monitoring()
+                existing[form_row['name']] = monitoring
+
+                db.session.add(monitoring)
+
+            form.populate_obj(monitoring)
+
+            changed.append(monitoring)
+
+        if changed:
+            db.session.flush()
+
+            Monitoring.bump_revision([monitoring.id for monitoring in changed])
+
+            db.session.commit()
+
+    if not dry_run and (counts['created'] or counts['updated']):
+        notify_monitorings_changed()
+
+    return counts
+
+
+def import_stream(stream, format, dry_run=False, max_errors=100):
+    """Import the monitorings from a binary stream (see import_monitorings()). Return the number of created, updated,
+    unchanged and invalid rows along with the errors of the first max_errors invalid rows."""
+    errors = []
+
+    def on_error(line_number, line_errors):
+        if len(errors) < max_errors:
+            errors.append({'line': line_number, 'errors': line_errors})
+
+    rows = read_rows(io.TextIOWrapper(stream, encoding='utf-8-sig', newline=''), format)
+
+    return dict(import_monitorings(rows, dry_run, on_error), errors=errors)
+
+
+def format_errors(errors):
+    return '; '.join('{}: {}'.format(field, ' '.join(messages)) for field, messages in errors.items())
@@ -0,0 +1,81 @@
+from flask import request, Response
+from collections import namedtuple
+from serverpatrol import app
+from models import *
+import threading
+import hashlib
+import arrow
+import time
+
+
+CacheEntry = namedtuple('CacheEntry', [
+    'generation',
+    'body',
+    'etag',
+    'last_modified',
+    'created_at'
+])
+
+
+class RenderCache:
+    """Per-process cache of rendered pages. An entry is valid as long as no monitoring status changed and no monitoring
+    was modified in the admin since it was rendered (see get_generation()), for at most max_age seconds so the relative
+    dates it contains don't get too stale."""
+    def __init__(self, max_age):
+        self.max_age = max_age
+
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def get(self, key, generation):
+        with self.lock:
+            entry = self.entries.get(key)
+
+        if not entry or entry.generation != generation:
+            return None
+
+        if self.max_age and time.monotonic() - entry.created_at > self.max_age:
+            return None
+
+        return entry
+
+    def set(self, key, generation, body):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+
+        entry = CacheEntry(
+            generation=generation,
+            body=body,
+            etag=hashlib.sha1(body).hexdigest(),
+            last_modified=arrow.utcnow().floor('second').datetime,
+            created_at=time.monotonic()
+        )
+
+        with self.lock:
+            self.entries[key] = entry
+
+        return entry
+
+
+render_cache = RenderCache(app.config['STATUS_PAGE_CACHE_MAX_AGE'])
+
+
+def get_generation():
+    return (get_statuses_changed_mtime(), get_monitorings_changed_mtime())
+
+
+def cached_response(key, render, mimetype='text/html'):
+    """Return the cached rendering of key if it's still valid, or call render() and cache its result. The response
+    supports conditional requests (ETag and Last-Modified)."""
+    generation = get_generation()
+    entry = render_cache.get(key, generation)
+
+    if not entry:
+        entry = render_cache.set(key, generation, render())
+
+    response = Response(entry.body, mimetype=mimetype)
+    response.set_etag(entry.etag)
+    response.last_modified = entry.last_modified
+    response.cache_control.no_cache = True # Clients must revalidate, which is cheap thanks to the 304 responses
+
+    return response.make_conditional(request)
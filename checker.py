@@ -0,0 +1,596 @@
+from transport import SessionPool, dns_cache, reset_timings, get_dns_duration, get_connect_duration, get_tls_duration
+from concurrent.futures import ThreadPoolExecutor, Future, as_completed
+from collections import namedtuple, defaultdict, deque
+from urllib.parse import urlsplit
+from functools import lru_cache
+from alerts import StatusChange
+from itertools import repeat
+from serverpatrol import app
+from metrics import metrics
+from flask_babel import _
+from models import *
+import threading
+import requests
+import codecs
+import heapq
+import click
+import time
+import re
+
+
+ProbeSpec = namedtuple('ProbeSpec', [
+    'method',
+    'url',
+    'timeout',
+    'verify_https_cert',
+    'http_headers',
+    'http_body_regex', # Compiled
+    'http_body_max_bytes',
+    'ignore_http_errors',
+    'retries'
+])
+
+ProbeResult = namedtuple('ProbeResult', [
+    'status',
+    'error',
+    'http_status_code',
+    'duration',
+    'dns_duration', # Only set when timings are measured
+    'connect_duration',
+    'tls_duration',
+    'ttfb_duration',
+    'body_duration', # Time spent matching the body against the Regex, if any
+    'attempts',
+    'started_at' # Timestamp at which the first attempt started
+])
+
+
+BODY_CHUNK_SIZE = 16 * 1024
+REUSABLE_BODY_MAX_BYTES = 64 * 1024 # Bodies not checked but smaller than this are read anyway so the connection can be reused
+
+
+class InvalidResponseBody(Exception):
+    def __init__(self, max_bytes_reached=None):
+        self.max_bytes_reached = max_bytes_reached
+
+
+# Exceptions meaning the monitoring is down. Anything else is a bug: it is logged by the engine, which reports the
+# monitoring as down as well (see CheckEngine._finish())
+PROBE_ERRORS = (
+    requests.exceptions.RequestException,
+    InvalidResponseBody
+)
+
+
+def get_probe_spec(monitoring):
+    return ProbeSpec(
+        method=monitoring.http_method.value,
+        url=monitoring.url,
+        timeout=monitoring.timeout if monitoring.timeout and monitoring.timeout > 0 else 10, # Invalid timeouts stored before they were validated
+        verify_https_cert=monitoring.verify_https_cert,
+        http_headers=monitoring.http_headers,
+        http_body_regex=compile_regex(monitoring.http_body_regex) if monitoring.http_body_regex else None,
+        http_body_max_bytes=monitoring.http_body_max_bytes or app.config['HTTP_BODY_MAX_BYTES'],
+        ignore_http_errors=monitoring.ignore_http_errors,
+        retries=(monitoring.retries or 0) if monitoring.status != MonitoringStatus.DOWN else 0 # Failures are only retried on the way down
+    )
+
+
+def get_coalescing_key(spec):
+    """Hashable identity of a ProbeSpec: probes having the same one send the same request and check its response the
+    same way, so they get the same result."""
+    return spec._replace(http_headers=tuple(sorted(spec.http_headers.items())) if spec.http_headers else None)
+
+
+def copy_outcome(source, destination):
+    """Complete a Future with the outcome of another one."""
+    if source.cancelled():
+        destination.cancel()
+    elif source.exception():
+        destination.set_exception(source.exception())
+    else:
+        destination.set_result(source.result())
+
+
+# Regex constructs whose outcome may change once more text follows the body read so far: anchors and boundaries looking
+# at the end of the input or at the next character, lookarounds, atomic groups and possessive quantifiers
+END_DEPENDENT_REGEX = re.compile(r'\$|\\[ZzbB]|\(\?<?[=!>]|[*+?}]\+')
+
+
+@lru_cache(maxsize=1024)
+def compile_regex(pattern):
+    return re.compile(pattern)
+
+
+@lru_cache(maxsize=1024)
+def can_stop_early(regex):
+    """Whether the given compiled regex matching the beginning of a body guarantees it matches the whole body. Errs on
+    the side of caution: a few regexes are needlessly matched against the whole body only."""
+    return not END_DEPENDENT_REGEX.search(regex.pattern)
+
+
+def release_connection(response):
+    """Make the connection of a response whose body isn't needed reusable, without downloading the body unless it is
+    small (closing a response with an unread body discards its connection)."""
+    content_length = response.headers.get('Content-Length', '')
+
+    if content_length.isdigit() and int(content_length) <= REUSABLE_BODY_MAX_BYTES:
+        response.content
+
+
+def body_matches(response, regex, max_bytes):
+    """Stream the response body and match it (re.match()) against the regex. If the regex can't depend on what follows
+    the text read so far (see can_stop_early()), it is matched as the body is downloaded, stopping as soon as it matches.
+    Otherwise it is only matched once the whole body is downloaded. Raise InvalidResponseBody if it doesn't match within
+    the first max_bytes bytes."""
+    try:
+        decoder = codecs.getincrementaldecoder(response.encoding or 'utf-8')(errors='replace')
+    except LookupError:
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+    stop_early = can_stop_early(regex)
+    body = ''
+    read_bytes = 0
+
+    for chunk in response.iter_content(chunk_size=BODY_CHUNK_SIZE):
+        chunk = chunk[:max_bytes - read_bytes]
+        read_bytes += len(chunk)
+        body += decoder.decode(chunk)
+
+        if stop_early and regex.match(body):
+            return True
+
+        if read_bytes >= max_bytes:
+            break
+
+    body += decoder.decode(b'', final=True)
+
+    if regex.match(body):
+        return True
+
+    if read_bytes >= max_bytes:
+        raise InvalidResponseBody(max_bytes)
+
+    return False
+
+
+def probe(spec, sessions):
+    """Perform the HTTP request described by a ProbeSpec using a session from the given SessionPool. Run in the engine's
+    worker threads, so it must not touch the database nor anything requiring the Flask app context."""
+    error = None
+    http_status_code = None
+    ttfb_duration = None
+    body_duration = None
+    started_at = time.time()
+    session = sessions.get(spec.url, spec.verify_https_cert)
+
+    reset_timings()
+
+    start = time.perf_counter()
+
+    try:
+        with session.request(spec.method, spec.url, timeout=spec.timeout, verify=spec.verify_https_cert, headers=spec.http_headers, stream=True) as response:
+            http_status_code = response.status_code
+            ttfb_duration = response.elapsed.total_seconds() # Time elapsed until the response headers were parsed
+
+            if not spec.http_body_regex:
+                release_connection(response)
+
+            # Only raise an HTTPError exception if we don't allow error HTTP statuses
+            if not spec.ignore_http_errors:
+                response.raise_for_status()
+
+            # Check the response body if this monitoring has a regex
+            if spec.http_body_regex:
+                body_start = time.perf_counter()
+
+                try:
+                    matches = body_matches(response, spec.http_body_regex, spec.http_body_max_bytes)
+                finally:
+                    body_duration = time.perf_counter() - body_start
+
+                if not matches:
+                    raise InvalidResponseBody()
+    except PROBE_ERRORS as e:
+        error = e
+    finally:
+        sessions.release(session)
+
+    return ProbeResult(
+        status=MonitoringStatus.DOWN if error else MonitoringStatus.UP,
+        error=error,
+        http_status_code=http_status_code,
+        duration=time.perf_counter() - start,
+        dns_duration=get_dns_duration() if sessions.measure_timings else None,
+        connect_duration=get_connect_duration() if sessions.measure_timings else None,
+        tls_duration=get_tls_duration() if sessions.measure_timings else None,
+        ttfb_duration=ttfb_duration if sessions.measure_timings else None,
+        body_duration=body_duration,
+        attempts=1,
+        started_at=started_at
+    )
+
+
+def get_failed_probe_result(error, attempts=1, started_at=None):
+    """ProbeResult of a probe which raised an unexpected exception."""
+    return ProbeResult(
+        status=MonitoringStatus.DOWN,
+        error=error,
+        http_status_code=None,
+        duration=0,
+        dns_duration=None,
+        connect_duration=None,
+        tls_duration=None,
+        ttfb_duration=None,
+        body_duration=None,
+        attempts=attempts,
+        started_at=started_at or time.time()
+    )
+
+
+def get_result(future):
+    """ProbeResult of a Future returned by CheckEngine.submit(). Never raises, so a single probe can't abort the
+    processing of the others."""
+    try:
+        return future.result()
+    except Exception as e:
+        app.logger.exception('Unexpected error while probing: {}'.format(e))
+
+        return get_failed_probe_result(e)
+
+
+def get_down_reason(error):
+    if isinstance(error, requests.exceptions.HTTPError): # Should not be encountered if monitoring.ignore_http_errors == True
+        return _('The server responded with an HTTP error: %(status_code)i %(reason)s.', status_code=error.response.status_code, reason=error.response.reason)
+    elif isinstance(error, requests.exceptions.TooManyRedirects):
+        return _('There were too many HTTP redirects (3xx HTTP status code).')
+    elif isinstance(error, requests.exceptions.ConnectTimeout):
+        return _('Connection to the server timed out.')
+    elif isinstance(error, requests.exceptions.ReadTimeout):
+        return _('The server took too long to respond.')
+    elif isinstance(error, requests.exceptions.SSLError):
+        return _('An SSL error occured: %(exception)s', exception=str(error))
+    elif isinstance(error, requests.exceptions.ProxyError):
+        return _('A proxy error occured: %(exception)s', exception=str(error))
+    elif isinstance(error, requests.exceptions.ConnectionError):
+        return _('Network error: unable to connect to the server.')
+    elif isinstance(error, InvalidResponseBody):
+        if error.max_bytes_reached:
+            return _('Response body check failed: the Regex doesn\'t match anything in the first %(max_bytes)i bytes.', max_bytes=error.max_bytes_reached)
+
+        return _('Response body check failed: the Regex doesn\'t match anything.')
+    elif isinstance(error, requests.exceptions.RequestException):
+        return _('The request failed: %(exception)s', exception=str(error))
+    else:
+        return _('The check failed because of an unexpected error: %(exception)s', exception=str(error))
+
+
+def get_dispatch_delays(monitorings, now, max_per_second=0, ignore_due=False):
+    """Number of seconds to wait, from the given timestamp, before probing each of the given monitorings (sorted by next
+    check) so each one is probed when it is due (unless ignore_due), and at most max_per_second of them (if set) are
+    probed each second."""
+    delays = []
+    dispatch_at = now
+
+    for monitoring in monitorings:
+        due_at = now if ignore_due else monitoring.next_check.float_timestamp
+
+        if max_per_second and delays:
+            dispatch_at = max(due_at, dispatch_at + 1 / max_per_second)
+        else:
+            dispatch_at = max(due_at, now)
+
+        delays.append(dispatch_at - now)
+
+    return delays
+
+
+class DelayedCalls:
+    """Call functions after a delay from a single background thread, started on first use."""
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.heap = []
+        self.sequence = 0
+        self.thread = None
+        self.stopped = False
+
+    def call_later(self, delay, function, *args):
+        with self.condition:
+            if self.stopped:
+                return
+
+            self.sequence += 1
+
+            heapq.heappush(self.heap, (time.monotonic() + delay, self.sequence, function, args))
+
+            if not self.thread:
+                self.thread = threading.Thread(target=self._run, name='check-retries', daemon=True)
+                self.thread.start()
+
+            self.condition.notify()
+
+    def shutdown(self):
+        """Stop the thread. Calls not made yet are dropped."""
+        with self.condition:
+            self.stopped = True
+            self.heap = []
+
+            self.condition.notify()
+
+        if self.thread:
+            self.thread.join()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.stopped and (not self.heap or self.heap[0][0] > time.monotonic()):
+                    self.condition.wait(self.heap[0][0] - time.monotonic() if self.heap else None)
+
+                if self.stopped:
+                    return
+
+                _, _, function, args = heapq.heappop(self.heap)
+
+            function(*args)
+
+
+class CheckEngine:
+    """Run probes concurrently in a pool of worker threads.
+
+    At most max_workers probes are in flight at the same time, and at most max_workers_per_host of them target the
+    same host. Probes exceeding the per-host limit wait in a queue without holding a worker thread.
+
+    A failed probe is retried up to spec.retries times, after retry_delay seconds doubled at each attempt. Retries
+    wait in the background as well, so they don't delay the other probes.
+
+    A probe identical to one already waiting or in progress (several monitorings of the same URL differing only by
+    their alerts or visibility) isn't performed again: it gets the result of the other one.
+
+    HTTP connections are kept alive and reused across checks of the same host, and host names are resolved through the
+    process-wide DNS cache, whose entries are kept dns_cache_ttl seconds (dns_cache_negative_ttl seconds for host names
+    which don't exist)."""
+    def __init__(self, max_workers, max_workers_per_host, max_sessions, session_idle_timeout, measure_timings, retry_delay=1, dns_cache_ttl=0, dns_cache_negative_ttl=0):
+        dns_cache.configure(dns_cache_ttl, dns_cache_negative_ttl)
+
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='check')
+        self.sessions = SessionPool(max_sessions, session_idle_timeout, max_workers_per_host, measure_timings)
+        self.max_workers_per_host = max_workers_per_host
+        self.retry_delay = retry_delay
+        self.delayed = DelayedCalls()
+        self.lock = threading.Lock()
+        self.running = defaultdict(int)
+        self.waiting = defaultdict(deque)
+        self.pending = {} # Coalescing key => Future of the probe waiting or in progress
+        self.started_at = {} # Future of a probe being retried => start of its first attempt
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
+
+    def submit(self, spec, delay=0):
+        """Probe the given ProbeSpec, after delay seconds if given, unless an identical probe is already pending. Return a
+        Future of the ProbeResult."""
+        key = get_coalescing_key(spec)
+        future = Future()
+
+        with self.lock:
+            pending = self.pending.get(key)
+
+            if not pending:
+                self.pending[key] = future
+
+        if pending:
+            metrics.inc('serverpatrol_coalesced_probes_total')
+
+            pending.add_done_callback(lambda pending: copy_outcome(pending, future))
+
+            return future
+
+        future.add_done_callback(lambda future: self._forget(key, future))
+
+        if delay > 0:
+            self.delayed.call_later(delay, self._enqueue, future, spec, 1)
+        else:
+            self._enqueue(future, spec, 1)
+
+        return future
+
+    def check(self, monitorings, delays=None):
+        """Probe the given monitorings, after the given number of seconds each if delays is given (see
+        get_dispatch_delays()), yielding (monitoring, ProbeResult) tuples in completion order. Monitorings sending the
+        same request are probed once, when the first of them is due."""
+        futures = {
+            self.submit_monitoring(monitoring, delay): monitoring for monitoring, delay in zip(monitorings, delays or repeat(0))
+        }
+
+        for future in as_completed(futures):
+            yield futures[future], get_result(future)
+
+    def submit_monitoring(self, monitoring, delay=0):
+        """Like submit(), with the ProbeSpec of the given monitoring. If it can't be built (e.g. invalid Regex), the
+        returned Future holds a DOWN result instead."""
+        try:
+            spec = get_probe_spec(monitoring)
+        except Exception as e:
+            app.logger.exception('Unable to probe {}: {}'.format(monitoring.name, e))
+
+            future = Future()
+            future.set_result(get_failed_probe_result(e))
+
+            return future
+
+        return self.submit(spec, delay)
+
+    def reap_idle_sessions(self):
+        """Close the HTTP sessions which weren't used recently. Called at the end of each tick, as sessions are
+        otherwise only reaped when another one is needed."""
+        self.sessions.reap()
+
+    def shutdown(self):
+        self.delayed.shutdown()
+        self.executor.shutdown(wait=True)
+        self.sessions.close()
+
+    def _forget(self, key, future):
+        with self.lock:
+            if self.pending.get(key) is future:
+                del self.pending[key]
+
+    def _enqueue(self, future, spec, attempt):
+        try:
+            host = urlsplit(spec.url).hostname
+        except ValueError: # Invalid URL: the probe will fail
+            host = None
+
+        with self.lock:
+            if self.running[host] >= self.max_workers_per_host:
+                self.waiting[host].append((future, spec, attempt))
+
+                return
+
+            self.running[host] += 1
+
+        self._start(host, future, spec, attempt)
+
+    def _start(self, host, future, spec, attempt):
+        if attempt == 1 and not future.set_running_or_notify_cancel():
+            self._release(host)
+
+            return
+
+        self.executor.submit(probe, spec, self.sessions).add_done_callback(lambda inner: self._finish(host, future, spec, attempt, inner))
+
+    def _finish(self, host, future, spec, attempt, inner):
+        if inner.exception(): # Bug in probe(): not retried
+            app.logger.error('Unexpected error while probing {}: {}'.format(spec.url, inner.exception()), exc_info=inner.exception())
+
+            future.set_result(get_failed_probe_result(inner.exception(), attempt, self.started_at.pop(future, None)))
+        elif inner.result().status == MonitoringStatus.DOWN and attempt <= spec.retries:
+            metrics.inc('serverpatrol_check_retries_total')
+
+            self.started_at.setdefault(future, inner.result().started_at)
+
+            self.delayed.call_later(self.retry_delay * 2 ** (attempt - 1), self._enqueue, future, spec, attempt + 1)
+        else:
+            future.set_result(inner.result()._replace(attempts=attempt, started_at=self.started_at.pop(future, inner.result().started_at)))
+
+        self._release(host)
+
+    def _release(self, host):
+        with self.lock:
+            if self.waiting[host]:
+                future, spec, attempt = self.waiting[host].popleft()
+            else:
+                self.running[host] -= 1
+
+                return
+
+        self._start(host, future, spec, attempt)
+
+
+def record_metrics(monitoring, result):
+    """Must be called before the monitoring is updated according to the result, while its next check is still the time
+    it was due."""
+    metrics.inc('serverpatrol_checks_total', status=result.status.value)
+    metrics.observe('serverpatrol_check_lateness_seconds', max(0, result.started_at - monitoring.next_check.float_timestamp))
+    metrics.observe('serverpatrol_check_duration_seconds', result.duration, monitoring_id=monitoring.id, monitoring=monitoring.name)
+
+    for phase in ('dns', 'connect', 'tls', 'ttfb', 'body'):
+        duration = getattr(result, phase + '_duration')
+
+        if duration is not None:
+            metrics.observe('serverpatrol_probe_phase_duration_seconds', duration, phase=phase)
+
+
+def is_status_change_confirmed(monitoring, status):
+    """Whether the status of a monitoring must change to the one resulting from its last check. A monitoring only goes
+    DOWN (resp. back UP) after down_confirmations (resp. up_confirmations) consecutive checks with this result, so a
+    single failure doesn't trigger alerts (flapping)."""
+    if status == monitoring.status:
+        monitoring.unconfirmed_checks_count = 0
+
+        return False
+
+    if monitoring.status == MonitoringStatus.UNKNOWN: # First check: nothing to confirm
+        return True
+
+    monitoring.unconfirmed_checks_count = (monitoring.unconfirmed_checks_count or 0) + 1
+
+    if status == MonitoringStatus.DOWN:
+        required = monitoring.down_confirmations or 1
+    else:
+        required = monitoring.up_confirmations or 1
+
+    if monitoring.unconfirmed_checks_count < required:
+        return False
+
+    monitoring.unconfirmed_checks_count = 0
+
+    return True
+
+
+def process_result(monitoring, result, now, alerts):
+    """Update a MonitoringSnapshot according to the result of its probe, queuing alerts in the given AlertDispatcher if
+    its status changed. Return the Check row to record, as a mapping."""
+    status = result.status
+
+    record_metrics(monitoring, result)
+
+    monitoring.status_changed = is_status_change_confirmed(monitoring, status)
+
+    if status == MonitoringStatus.DOWN:
+        monitoring.last_down_reason = get_down_reason(result.error)
+
+    click.echo(monitoring.name)
+    click.echo('  Checked: {} {} ({:.3f}s)'.format(monitoring.http_method.value, monitoring.url, result.duration))
+    click.echo('  ' + status.value + (' (' + monitoring.last_down_reason + ')' if status == MonitoringStatus.DOWN else ''))
+
+    if result.attempts > 1:
+        click.echo('  Attempts: {}'.format(result.attempts))
+
+    if monitoring.unconfirmed_checks_count:
+        click.echo('  Status change not confirmed yet ({} check(s))'.format(monitoring.unconfirmed_checks_count))
+
+    if monitoring.status_changed: # The status is different from the one in DB: update it and send alerts if required
+        click.echo('  Status is different')
+
+        old_status_known = monitoring.status != MonitoringStatus.UNKNOWN
+
+        monitoring.last_status_change_at = now
+        monitoring.status = status
+
+        if old_status_known: # Only send alerts if the old status is known (i.e not a newly-created monitoring)
+            email_recipients = monitoring.email_recipients if app.config['ENABLE_EMAIL_ALERTS'] else None # Email alerts enabled?
+            sms_recipients = monitoring.sms_recipients if app.config['ENABLE_SMS_ALERTS'] else None # SMS alerts enabled?
+
+            if email_recipients:
+                click.echo('  Queuing emails to {}'.format(email_recipients))
+
+            if sms_recipients:
+                click.echo('  Queuing SMS to {}'.format(sms_recipients))
+
+            if email_recipients or sms_recipients:
+                alerts.send_status_change(StatusChange(
+                    name=monitoring.name,
+                    url=monitoring.url,
+                    status=status,
+                    last_down_reason=monitoring.last_down_reason,
+                    last_status_change_at=now,
+                    email_recipients=email_recipients or [],
+                    sms_recipients=sms_recipients or []
+                ))
+
+    monitoring.last_checked_at = now
+
+    return {
+        'monitoring_id': monitoring.id,
+        'date_time': now,
+        'status': status,
+        'http_status_code': result.http_status_code,
+        'request_duration': round(result.duration * 1000),
+        'connect_duration': round((result.dns_duration + result.connect_duration + result.tls_duration) * 1000) if result.connect_duration is not None else None,
+        'ttfb_duration': round(result.ttfb_duration * 1000) if result.ttfb_duration is not None else None,
+        'down_reason': monitoring.last_down_reason if status == MonitoringStatus.DOWN else None
+    }
@@ -1,16 +1,48 @@
-from serverpatrol import app, db, mail
-from flask import render_template
-from flask_mail import Message
-from flask_babel import _
+from checker import CheckEngine, process_result, get_dispatch_delays
+from metrics import metrics, PhaseTimer, log_tick
+from alerts import AlertDispatcher
+from serverpatrol import app, db
+from scheduler import Scheduler
+from leases import LeaseManager
+from collections import Counter
 from models import *
-import twilio.rest
-import requests
+import history
+import schema
+import signal
 import click
 import arrow
-import math
+import bulk
 import time
-import os
-import re
+
+
+def create_check_engine():
+    return CheckEngine(
+        app.config['CHECKS_MAX_WORKERS'],
+        app.config['CHECKS_MAX_WORKERS_PER_HOST'],
+        app.config['HTTP_POOL_MAX_HOSTS'],
+        app.config['HTTP_POOL_IDLE_TIMEOUT'],
+        app.config['CHECKS_MEASURE_TIMINGS'],
+        app.config['CHECKS_RETRY_DELAY'],
+        app.config['DNS_CACHE_TTL'],
+        app.config['DNS_CACHE_NEGATIVE_TTL']
+    )
+
+
+def create_alert_dispatcher():
+    return AlertDispatcher(
+        app.config['ALERTS_MAX_RETRIES'],
+        app.config['ALERTS_RETRY_DELAY'],
+        app.config['SMS_PER_SECOND'],
+        app.config['SMS_BURST'],
+        app.config['ALERTS_DIGEST_WINDOW']
+    )
+
+
+def create_lease_manager(node):
+    try:
+        return LeaseManager(app.config['CHECKS_LEASE_DURATION'], node or app.config['CHECKS_NODE'], app.config['CHECKS_NODES'])
+    except ValueError as e:
+        raise click.UsageError(str(e))
 
 
 @app.cli.command()
@@ -33,141 +65,189 @@ def create_database():
 
 
 @app.cli.command()
-@click.option('--force', is_flag=True, default=False, help='Force checks whenever monitorings are due or not')
-def check(force):
-    """Perform all checks for the active monitorings."""
-    lock_file = 'storage/.running'
+def upgrade_database():
+    """Update the database tables created by a former version, keeping their data."""
+    schema.upgrade_database(click.echo)
 
-    if os.path.isfile(lock_file):
-        click.echo('Checks already running, aborting', err=True)
-        click.echo('Maybe Server Patrol crashed. Please delete the storage/.running file before running this command again.', err=True)
-        click.echo('If this happens too many times, please open an issue.', err=True)
+    click.secho('Done', fg='green')
 
-        return
 
-    open(lock_file, 'a').close() # Create the lock file
+def check_monitorings(monitorings, engine, alerts, timer, delays=None):
+    """Check the given monitorings (MonitoringSnapshot instances), after the given delays if any (see
+    get_dispatch_delays()), and save the results by batches of CHECKS_COMMIT_BATCH_SIZE, measuring the time spent in
+    each phase using the given PhaseTimer. Return the time at which the last check started, if any."""
+    checked = []
+    checks = []
+    last_started_at = None
+    results = engine.check(monitorings, delays)
+
+    while True:
+        with timer.phase('probe'): # Waiting for the next probe to complete
+            monitoring, result = next(results, (None, None))
+
+        if not monitoring:
+            break
+
+        last_started_at = max(last_started_at or 0, result.started_at)
+
+        with timer.phase('status_diff'):
+            checks.append(process_result(monitoring, result, arrow.now(), alerts))
+
+        checked.append(monitoring)
 
-    click.echo('Getting all active monitorings')
+        if len(checks) >= app.config['CHECKS_COMMIT_BATCH_SIZE']:
+            with timer.phase('commit'):
+                history.save_checks(checked, checks)
+
+            checked = []
+            checks = []
+
+    with timer.phase('commit'):
+        history.save_checks(checked, checks)
+
+    engine.reap_idle_sessions()
+
+    return last_started_at
+
+
+@app.cli.command()
+@click.option('--force', is_flag=True, default=False, help='Force checks whenever monitorings are due or not')
+@click.option('--node', default=None, help='Name of the node running this command when sharding is enabled (defaults to CHECKS_NODE)')
+def check(force, node):
+    """Perform all checks for the active monitorings."""
+    start = time.perf_counter()
+    timer = PhaseTimer()
+    leases = create_lease_manager(node)
+
+    click.echo('Getting the active monitorings to check')
 
     if force:
         click.echo('  Ignoring monitorings due')
 
-    monitorings = Monitoring.query.get_for_checking()
+    next_run_at = arrow.now().floor('minute').shift(minutes=1) # This command is run every minute
+    due_before = None if force else next_run_at
+
+    with timer.phase('query'):
+        monitorings = Monitoring.query.get_for_checking(due_before=due_before)
+
+        click.echo('{} monitorings found'.format(len(monitorings)))
+
+        monitorings = leases.claim(monitorings, arrow.now(), due_before)
 
     click.echo('{} monitorings to check'.format(len(monitorings)))
 
-    for monitoring in monitorings:
-        click.echo(monitoring.name)
+    # Monitorings due later in the minute are checked when they are due, unless forced
+    delays = get_dispatch_delays(monitorings, time.time(), app.config['CHECKS_MAX_PER_SECOND'], ignore_due=force)
 
-        now = arrow.now().floor('minute')
+    with create_check_engine() as engine, create_alert_dispatcher() as alerts:
+        last_started_at = check_monitorings(monitorings, engine, alerts, timer, delays)
 
-        if not force and now < monitoring.next_check: # This monitoring isn't due
-            click.echo('  Not due')
-            continue
+        click.echo('Waiting for the alerts to be sent')
 
-        status = MonitoringStatus.UP
+        with timer.phase('alerts'):
+            alerts.close()
 
-        click.echo('  Checking: {} {}'.format(monitoring.http_method.value, monitoring.url))
+    duration = time.perf_counter() - start
+    overran = last_started_at is not None and last_started_at >= next_run_at.float_timestamp # Checks can't all be started within the minute
 
-        try:
-            response = requests.request(monitoring.http_method.value, monitoring.url, timeout=monitoring.timeout, verify=monitoring.verify_https_cert, headers=monitoring.http_headers)
-
-            # Only raise an HTTPError exception if we don't allow error HTTP statuses
-            if not monitoring.ignore_http_errors:
-                response.raise_for_status()
-
-            # Check the response body if this monitoring has a regex
-            if monitoring.http_body_regex and not re.match(monitoring.http_body_regex, response.text):
-                raise InvalidResponseBody()
-        except requests.exceptions.HTTPError: # Should not be encountered if monitoring.ignore_http_errors == True
-            status = MonitoringStatus.DOWN
-            monitoring.last_down_reason = _('The server responded with an HTTP error: %(status_code)i %(reason)s.', status_code=response.status_code, reason=response.reason)
-        except requests.exceptions.TooManyRedirects:
-            status = MonitoringStatus.DOWN
-            monitoring.last_down_reason = _('There were too many HTTP redirects (3xx HTTP status code).')
-        except requests.exceptions.ConnectTimeout:
-            status = MonitoringStatus.DOWN
-            monitoring.last_down_reason = _('Connection to the server timed out.')
-        except requests.exceptions.ReadTimeout:
-            status = MonitoringStatus.DOWN
-            monitoring.last_down_reason = _('The server took too long to respond.')
-        except requests.exceptions.SSLError as se:
-            status = MonitoringStatus.DOWN
-            monitoring.last_down_reason = _('An SSL error occured: %(exception)s', exception=str(se))
-        except requests.exceptions.ProxyError as pe:
-            status = MonitoringStatus.DOWN
-            monitoring.last_down_reason = _('A proxy error occured: %(exception)s', exception=str(pe))
-        except requests.exceptions.ConnectionError:
-            status = MonitoringStatus.DOWN
-            monitoring.last_down_reason = _('Network error: unable to connect to the server.')
-        except InvalidResponseBody:
-            status = MonitoringStatus.DOWN
-            monitoring.last_down_reason = _('Response body check failed: the Regex doesn\'t match anything.')
-
-        click.echo('  ' + status.value + (' (' + monitoring.last_down_reason + ')' if status == MonitoringStatus.DOWN else ''))
-
-        if monitoring.status != status: # The status is different from the one in DB: update it and send alerts if required
-            click.echo('  Status is different')
-
-            old_status_known = monitoring.status != MonitoringStatus.UNKNOWN
-
-            monitoring.last_status_change_at = now
-            monitoring.status = status
-
-            if old_status_known: # Only send alerts if the old status is known (i.e not a newly-created monitoring)
-                if app.config['ENABLE_EMAIL_ALERTS'] and monitoring.email_recipients: # Email alerts enabled?
-                    click.echo('  Sending emails to {}'.format(monitoring.email_recipients))
-
-                    msg = Message()
-                    msg.recipients = monitoring.email_recipients
-
-                    if status == MonitoringStatus.DOWN: # The new status is down?
-                        msg.subject = _('%(monitoring_name)s is gone', monitoring_name=monitoring.name)
-                        msg.extra_headers = {
-                            'X-Priority': '1',
-                            'X-MSMail-Priority': 'High',
-                            'Importance': 'High'
-                        }
-                    elif status == MonitoringStatus.UP: # The new status is up?
-                        msg.subject = _('%(monitoring_name)s is back up', monitoring_name=monitoring.name)
-
-                    msg.body = render_template('emails/status_changed.txt', monitoring=monitoring)
-                    msg.html = render_template('emails/status_changed.html', monitoring=monitoring)
-
-                    try:
-                        mail.send(msg)
-                    except Exception as e:
-                        click.echo('  Error sending emails: {}'.format(e))
-
-                if app.config['ENABLE_SMS_ALERTS'] and monitoring.sms_recipients: # SMS alerts enabled?
-                    click.echo('  Sending SMS to {}'.format(monitoring.sms_recipients))
-
-                    sms_body = render_template('sms/status_changed.txt', monitoring=monitoring)
-
-                    twilio_client = twilio.rest.Client(app.config['TWILIO_ACCOUNT_SID'], app.config['TWILIO_AUTH_TOKEN'])
-
-                    for sms_recipient in monitoring.sms_recipients:
-                        try:
-                            twilio_client.messages.create(
-                                to=sms_recipient,
-                                from_=app.config['TWILIO_SENDER_PHONE_NUMBER'],
-                                body=sms_body
-                            )
-
-                            # Do not send more than one SMS per second
-                            time.sleep(1)
-                        except Exception as e:
-                            click.echo('  Error sending SMS: {}'.format(e), err=True)
-
-        monitoring.last_checked_at = now
-
-        db.session.add(monitoring)
-        db.session.commit()
-
-    os.remove(lock_file)
+    if overran:
+        click.echo('The last check started {:.1f}s after the next run began'.format(last_started_at - next_run_at.float_timestamp), err=True)
+
+        metrics.inc('serverpatrol_tick_overruns_total')
+
+    metrics.observe('serverpatrol_tick_duration_seconds', duration)
+    timer.observe()
+
+    log_tick(
+        event='tick',
+        date=arrow.now().isoformat(),
+        owner=leases.owner,
+        checks=len(monitorings),
+        statuses=Counter(monitoring.status.value for monitoring in monitorings),
+        status_changes=sum(1 for monitoring in monitorings if monitoring.status_changed),
+        duration=duration,
+        overran=overran,
+        phases=timer.durations
+    )
+
+    metrics.flush(Monitoring.query.get_active_names())
 
     click.secho('Done', fg='green')
 
 
-class InvalidResponseBody(Exception):
-    pass
+@app.cli.command()
+def downsample_checks():
+    """Delete the old checks and hourly statistics, which are already accounted for in the hourly (resp. daily) ones."""
+    now = arrow.now()
+
+    click.echo('Downsampling checks')
+
+    counts = history.downsample_checks(
+        now.shift(days=-app.config['CHECKS_RETENTION_DAYS']).floor('hour'),
+        now.shift(days=-app.config['HOURLY_CHECK_ROLLUPS_RETENTION_DAYS']).floor('day')
+    )
+
+    click.echo('  {deleted_checks} checks deleted'.format(**counts))
+    click.echo('  {deleted_hourly_rollups} hourly rollups deleted'.format(**counts))
+
+    click.secho('Done', fg='green')
+
+
+@app.cli.command()
+@click.argument('output', type=click.File('w', encoding='utf-8'), default='-')
+@click.option('--format', 'format_', type=click.Choice(bulk.FORMATS), default=None, help='Format of the file (defaults to csv if OUTPUT ends with .csv, jsonl otherwise)')
+def export_monitorings(output, format_):
+    """Write all the monitorings to OUTPUT (defaults to the standard output) as JSON Lines or CSV."""
+    for chunk in bulk.export_monitorings(format_ or bulk.get_format(output.name)):
+        output.write(chunk)
+
+
+@app.cli.command()
+@click.argument('input_', metavar='INPUT', type=click.File('r', encoding='utf-8-sig'), default='-')
+@click.option('--format', 'format_', type=click.Choice(bulk.FORMATS), default=None, help='Format of the file (defaults to csv if INPUT ends with .csv, jsonl otherwise)')
+@click.option('--dry-run', is_flag=True, default=False, help='Only validate the monitorings, without saving them')
+def import_monitorings(input_, format_, dry_run):
+    """Create or update (by name) the monitorings from INPUT (defaults to the standard input), as JSON Lines or CSV.
+    Columns missing from a row keep their current value (or the default one for new monitorings)."""
+    def on_error(line_number, errors):
+        click.secho('Line {}: {}'.format(line_number, bulk.format_errors(errors)), fg='red', err=True)
+
+    rows = bulk.read_rows(input_, format_ or bulk.get_format(input_.name))
+    counts = bulk.import_monitorings(rows, dry_run, on_error)
+
+    click.echo('{created} created, {updated} updated, {unchanged} unchanged, {invalid} invalid'.format(**counts))
+
+    if dry_run:
+        click.echo('Nothing saved (dry run)')
+
+    click.secho('Done', fg='green' if not counts['invalid'] else 'yellow')
+
+
+@app.cli.command()
+@click.option('--node', default=None, help='Name of the node running this command when sharding is enabled (defaults to CHECKS_NODE)')
+def patrol(node):
+    """Continuously perform the checks for the active monitorings, as soon as they are due."""
+    leases = create_lease_manager(node)
+
+    click.echo('Starting patrol')
+
+    signal.signal(signal.SIGTERM, signal.default_int_handler) # Stop gracefully on SIGTERM as well
+
+    with create_check_engine() as engine, create_alert_dispatcher() as alerts:
+        scheduler = Scheduler(
+            engine,
+            alerts,
+            leases,
+            app.config['PATROL_RELOAD_INTERVAL'],
+            app.config['PATROL_RESYNC_INTERVAL'],
+            app.config['CHECKS_MAX_PER_SECOND']
+        )
+
+        try:
+            scheduler.run()
+        except KeyboardInterrupt:
+            click.echo('Stopping patrol, waiting for running checks to complete')
+
+    metrics.flush(Monitoring.query.get_active_names())
+
+    click.secho('Done', fg='green')
@@ -4,6 +4,12 @@ SERVER_NAME = 'localhost:8080'
 FORCE_LANGUAGE = None
 DEFAULT_LANGUAGE = 'en'
 TITLE = None
+STATUS_PAGE_CACHE_MAX_AGE = 60
+MONITORINGS_PER_PAGE = 50
+STREAM_POLL_INTERVAL = 2
+STREAM_KEEPALIVE_INTERVAL = 15
+STREAM_MAX_SUBSCRIBERS = None
+STREAM_FALLBACK_POLL_INTERVAL = 30
 ENABLE_EMAIL_ALERTS = False
 MAIL_SERVER = 'localhost'
 MAIL_PORT = 25
@@ -16,3 +22,28 @@ ENABLE_SMS_ALERTS = False
 TWILIO_ACCOUNT_SID = ''
 TWILIO_AUTH_TOKEN = ''
 TWILIO_SENDER_PHONE_NUMBER = ''
+SMS_PER_SECOND = 1
+SMS_BURST = 1
+CHECKS_MAX_WORKERS = 20
+CHECKS_MAX_WORKERS_PER_HOST = 2
+CHECKS_MEASURE_TIMINGS = False
+CHECKS_RETRY_DELAY = 1
+CHECKS_JITTER = 5
+CHECKS_MAX_PER_SECOND = 0
+HTTP_POOL_MAX_HOSTS = 100
+HTTP_POOL_IDLE_TIMEOUT = 60
+HTTP_BODY_MAX_BYTES = 1024 * 1024
+DNS_CACHE_TTL = 60
+DNS_CACHE_NEGATIVE_TTL = 10
+PATROL_RELOAD_INTERVAL = 5
+PATROL_RESYNC_INTERVAL = 300
+CHECKS_RETENTION_DAYS = 7
+HOURLY_CHECK_ROLLUPS_RETENTION_DAYS = 90
+CHECKS_COMMIT_BATCH_SIZE = 500
+CHECKS_LEASE_DURATION = 300
+CHECKS_NODES = []
+CHECKS_NODE = None
+SQLITE_WAL = False
+ALERTS_MAX_RETRIES = 3
+ALERTS_RETRY_DELAY = 10
+ALERTS_DIGEST_WINDOW = 30
@@ -1,26 +1,85 @@
 from wtforms import StringField, BooleanField, SelectField, IntegerField, TextAreaField
+from flask_wtf.file import FileField, FileRequired
 from flask_babel import lazy_gettext as __
 from flask_wtf import FlaskForm
 from models import *
 import wtforms.validators as validators
+import json
 
 
 __all__ = [
-    'MonitoringForm'
+    'MonitoringForm',
+    'ImportMonitoringsForm',
+    'MonitoringsFilterForm'
 ]
 
 
+class JsonDocument:
+    """Validate the field contains, if not empty, a JSON document of the given type (dict or list) whose values are
+    all strings."""
+    def __init__(self, type_):
+        self.type_ = type_
+
+    def __call__(self, form, field):
+        if not field.data:
+            return
+
+        try:
+            value = json.loads(field.data)
+        except ValueError:
+            raise validators.ValidationError(__('Invalid JSON document.'))
+
+        values = value.values() if isinstance(value, dict) else value
+
+        if not isinstance(value, self.type_) or not all(isinstance(item, str) for item in values):
+            raise validators.ValidationError(__('Invalid value.'))
+
+
 class MonitoringForm(FlaskForm):
     name = StringField(__('Name'), [validators.DataRequired(), validators.length(max=255)])
     is_active = BooleanField(__('Active?'), default=False)
     is_public = BooleanField(__('Public?'), default=False)
     url = StringField(__('URL to check'), [validators.DataRequired(), validators.URL(), validators.length(max=255)])
     http_method = SelectField(__('HTTP method to use'), choices=[(method.value, method.name) for method in MonitoringHttpMethod], default=MonitoringHttpMethod.GET.value)
-    http_headers = TextAreaField(__('HTTP headers to send'))
+    http_headers = TextAreaField(__('HTTP headers to send'), [JsonDocument(dict)])
     http_body_regex = StringField(__('HTTP response body Regex check'), [validators.length(max=255)])
+    http_body_max_bytes = IntegerField(__('Maximum response body size to check (bytes)'), [validators.Optional(), validators.NumberRange(min=1)])
     verify_https_cert = BooleanField(__('Verify HTTPS certificate?'), default=True)
-    check_interval = IntegerField(__('Check interval (minutes)'), default=5)
-    timeout = IntegerField(__('Connection timeout (seconds)'), default=10)
-    email_recipients = TextAreaField(__('Recipients of the email alerts'))
-    sms_recipients = TextAreaField(__('Recipients of the SMS alerts'))
+    check_interval = IntegerField(__('Check interval (minutes)'), [validators.NumberRange(min=1)], default=5)
+    down_check_interval = IntegerField(__('Check interval while down (minutes)'), [validators.Optional(), validators.NumberRange(min=1)])
+    timeout = IntegerField(__('Connection timeout (seconds)'), [validators.NumberRange(min=1)], default=10)
+    email_recipients = TextAreaField(__('Recipients of the email alerts'), [JsonDocument(list)])
+    sms_recipients = TextAreaField(__('Recipients of the SMS alerts'), [JsonDocument(list)])
     ignore_http_errors = BooleanField(__('Ignore HTTP errors?'), default=False)
+    down_confirmations = IntegerField(__('Failed checks before going down'), [validators.NumberRange(min=1, max=10)], default=1)
+    up_confirmations = IntegerField(__('Successful checks before going back up'), [validators.NumberRange(min=1, max=10)], default=1)
+    retries = IntegerField(__('Immediate retries of a failed check'), [validators.NumberRange(min=0, max=5)], default=0)
+
+
+class ImportMonitoringsForm(FlaskForm):
+    file = FileField(__('JSON Lines or CSV file'), [FileRequired()])
+
+
+class MonitoringsFilterForm(FlaskForm):
+    """Filters of the statuses page and of the admin list, submitted in the query string."""
+    class Meta:
+        csrf = False
+
+    status = SelectField(__('Status'), choices=[('', __('All')), (MonitoringStatus.DOWN.value, __('Down')), (MonitoringStatus.UNKNOWN.value, __('Unknown')), (MonitoringStatus.UP.value, __('Up'))], default='')
+    is_active = SelectField(__('Active?'), choices=[('', __('All')), ('1', __('Yes')), ('0', __('No'))], default='')
+    is_public = SelectField(__('Public?'), choices=[('', __('All')), ('1', __('Yes')), ('0', __('No'))], default='')
+    search = StringField(__('Name'), [validators.length(max=255)])
+    order = SelectField(__('Sort by'), choices=[('problems', __('Problems first')), ('name', __('Name'))])
+
+    def get_criteria(self, with_flags=True):
+        """Arguments of MonitoringQuery.filter_by_criteria() matching the submitted filters."""
+        criteria = {
+            'status': MonitoringStatus(self.status.data) if self.status.data else None,
+            'search': self.search.data.strip() if self.search.data else None
+        }
+
+        if with_flags:
+            criteria['is_active'] = self.is_active.data == '1' if self.is_active.data else None
+            criteria['is_public'] = self.is_public.data == '1' if self.is_public.data else None
+
+        return criteria
@@ -0,0 +1,169 @@
+from collections import defaultdict, OrderedDict
+from sketches import DurationSketch
+from itertools import islice
+from serverpatrol import db
+from models import *
+
+
+INSERT_BATCH_SIZE = 1000
+QUERY_BATCH_SIZE = 500 # Maximum number of monitoring IDs in an IN clause
+
+# Name => (rollups period, number of periods). The current, incomplete period is one of them
+REPORT_WINDOWS = OrderedDict([
+    ('24h', (CheckRollupPeriod.HOUR, 24)),
+    ('7d', (CheckRollupPeriod.DAY, 7)),
+    ('30d', (CheckRollupPeriod.DAY, 30))
+])
+
+REPORT_PERCENTILES = (50, 95, 99)
+
+
+def record_checks(checks):
+    """Bulk-insert Check rows (as mappings). The caller is responsible for committing."""
+    checks = iter(checks)
+
+    while True:
+        batch = list(islice(checks, INSERT_BATCH_SIZE))
+
+        if not batch:
+            break
+
+        db.session.bulk_insert_mappings(Check, batch)
+
+
+def save_checks(monitorings, checks):
+    """Commit the monitorings (MonitoringSnapshot instances) updated by process_result() along with their checks and
+    rollups, in a single transaction."""
+    if not checks:
+        return
+
+    db.session.bulk_update_mappings(Monitoring, [monitoring.to_mapping() for monitoring in monitorings])
+
+    Monitoring.bump_revision([monitoring.id for monitoring in monitorings])
+
+    record_checks(checks)
+    update_rollups(checks)
+
+    db.session.commit()
+
+    if any(monitoring.status_changed for monitoring in monitorings):
+        notify_statuses_changed()
+
+
+def get_period_start(date_time, period):
+    return date_time.to('UTC').floor(period.value.lower())
+
+
+def update_rollups(checks):
+    """Account the given checks (as mappings) in the hourly and daily rollups of their monitoring, creating them if
+    needed. The caller is responsible for committing."""
+    groups = defaultdict(list)
+
+    for check in checks:
+        for period in CheckRollupPeriod:
+            groups[(check['monitoring_id'], period, get_period_start(check['date_time'], period))].append(check)
+
+    monitoring_ids = sorted({monitoring_id for monitoring_id, _, _ in groups})
+    period_starts = {date_time for _, _, date_time in groups}
+    existing = {}
+
+    for i in range(0, len(monitoring_ids), QUERY_BATCH_SIZE):
+        existing.update({
+            (rollup.monitoring_id, rollup.period, rollup.date_time): rollup for rollup in CheckRollup.query.filter(
+                CheckRollup.monitoring_id.in_(monitoring_ids[i:i + QUERY_BATCH_SIZE]),
+                CheckRollup.date_time.in_(period_starts)
+            )
+        })
+
+    for (monitoring_id, period, date_time), group in groups.items():
+        rollup = existing.get((monitoring_id, period, date_time))
+
+        if not rollup:
+            rollup = CheckRollup(monitoring_id=monitoring_id, period=period, date_time=date_time)
+
+            db.session.add(rollup)
+
+        rollup.add_checks(group)
+
+
+def get_window_start(now, period, periods_count):
+    return get_period_start(now, period).shift(**{period.value.lower() + 's': 1 - periods_count})
+
+
+def get_reports(monitoring_ids, now):
+    """Compute the uptime ratio and request duration percentiles of the given monitorings over each one of the
+    REPORT_WINDOWS, by merging their rollups. Return a dict: monitoring ID => window name => report."""
+    accumulators = {
+        monitoring_id: {
+            window: {'checks_count': 0, 'up_count': 0, 'sketch': DurationSketch()} for window in REPORT_WINDOWS
+        } for monitoring_id in monitoring_ids
+    }
+
+    for period in CheckRollupPeriod:
+        windows = OrderedDict([
+            (window, get_window_start(now, period, periods_count)) for window, (window_period, periods_count) in REPORT_WINDOWS.items() if window_period == period
+        ])
+
+        if not windows:
+            continue
+
+        for i in range(0, len(monitoring_ids), QUERY_BATCH_SIZE):
+            rollups = db.session.query(
+                CheckRollup.monitoring_id,
+                CheckRollup.date_time,
+                CheckRollup.checks_count,
+                CheckRollup.up_count,
+                CheckRollup.request_duration_sketch
+            ).filter(
+                CheckRollup.monitoring_id.in_(monitoring_ids[i:i + QUERY_BATCH_SIZE]),
+                CheckRollup.period == period,
+                CheckRollup.date_time >= min(windows.values())
+            )
+
+            for rollup in rollups:
+                sketch = DurationSketch(rollup.request_duration_sketch)
+
+                for window, start in windows.items():
+                    if rollup.date_time < start:
+                        continue
+
+                    accumulator = accumulators[rollup.monitoring_id][window]
+                    accumulator['checks_count'] += rollup.checks_count
+                    accumulator['up_count'] += rollup.up_count
+                    accumulator['sketch'].merge(sketch)
+
+    return {
+        monitoring_id: {
+            window: report_from_accumulator(accumulator) for window, accumulator in monitoring_accumulators.items()
+        } for monitoring_id, monitoring_accumulators in accumulators.items()
+    }
+
+
+def report_from_accumulator(accumulator):
+    report = {
+        'checks_count': accumulator['checks_count'],
+        'uptime_ratio': accumulator['up_count'] / accumulator['checks_count'] if accumulator['checks_count'] else None
+    }
+
+    for p in REPORT_PERCENTILES:
+        report['request_duration_p{}'.format(p)] = accumulator['sketch'].quantile(p / 100)
+
+    return report
+
+
+def downsample_checks(checks_before, hourly_rollups_before):
+    """Delete the checks older than checks_before, and the hourly rollups older than hourly_rollups_before. They are
+    already accounted for in the hourly (resp. daily) rollups, which are updated as the checks are saved."""
+    deleted_checks_count = Check.query.filter(Check.date_time < checks_before).delete(synchronize_session=False)
+
+    deleted_hourly_rollups_count = CheckRollup.query.filter(
+        CheckRollup.period == CheckRollupPeriod.HOUR,
+        CheckRollup.date_time < hourly_rollups_before
+    ).delete(synchronize_session=False)
+
+    db.session.commit()
+
+    return {
+        'deleted_checks': deleted_checks_count,
+        'deleted_hourly_rollups': deleted_hourly_rollups_count
+    }
@@ -1,6 +1,6 @@
 from flask import render_template, make_response, g, request
 from werkzeug.exceptions import HTTPException
-from serverpatrol import app, babel, auth
+from serverpatrol import app, auth
 
 
 @app.before_request
@@ -25,14 +25,6 @@ def auth_error():
     return http_error_handler(403, without_code=True)
 
 
-@babel.localeselector
-def get_app_locale():
-    if not hasattr(g, 'CURRENT_LOCALE'):
-        return app.config['DEFAULT_LANGUAGE']
-    else:
-        return g.CURRENT_LOCALE
-
-
 @app.errorhandler(401)
 @app.errorhandler(403)
 @app.errorhandler(404)
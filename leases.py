@@ -0,0 +1,68 @@
+from serverpatrol import db
+from models import *
+import hashlib
+import socket
+import uuid
+import os
+
+
+CLAIM_BATCH_SIZE = 500
+
+
+def shard_weight(node, monitoring_id):
+    digest = hashlib.md5('{}:{}'.format(node, monitoring_id).encode('utf-8')).digest()
+
+    return int.from_bytes(digest[:8], 'big')
+
+
+class LeaseManager:
+    """Share the monitorings between several checker processes (flask check or flask patrol), on the same machine or not.
+
+    Before checking monitorings, a process leases them for lease_duration seconds. A monitoring leased by another
+    process is skipped until its lease expires, so the monitorings of a crashed process are picked up again. Leases are
+    released when the checks are saved.
+
+    If nodes is given, each monitoring is assigned to one of them using rendezvous (highest random weight) hashing: a
+    process only claims the monitorings of its node, and adding or removing a node only moves the monitorings of this
+    node. The monitorings of a node which is down are claimed by the other ones once they are late by more than
+    lease_duration seconds."""
+    def __init__(self, lease_duration, node=None, nodes=None):
+        self.lease_duration = lease_duration
+        self.node = node
+        self.nodes = nodes or []
+        self.owner = '{}:{}:{}'.format(node or socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+
+        if self.nodes and self.node not in self.nodes:
+            raise ValueError('The node "{}" is not one of {}'.format(self.node, ', '.join(self.nodes)))
+
+    def is_assigned(self, monitoring_id):
+        """Whether the given monitoring belongs to this process' node."""
+        if not self.nodes:
+            return True
+
+        return max(self.nodes, key=lambda node: shard_weight(node, monitoring_id)) == self.node
+
+    def claim(self, monitorings, now, due_before=None):
+        """Lease the given monitorings (MonitoringSnapshot instances) to this process, and return the ones which were
+        actually claimed. If due_before is given, monitorings no longer due at this date (i.e checked by another
+        process in the meantime) aren't claimed."""
+        late_before = now.shift(seconds=-self.lease_duration)
+
+        monitorings = [
+            monitoring for monitoring in monitorings if self.is_assigned(monitoring.id) or monitoring.next_check < late_before
+        ]
+
+        claimed_ids = set()
+
+        for i in range(0, len(monitorings), CLAIM_BATCH_SIZE):
+            claimed_ids.update(Monitoring.claim(
+                [monitoring.id for monitoring in monitorings[i:i + CLAIM_BATCH_SIZE]],
+                self.owner,
+                now.shift(seconds=self.lease_duration),
+                now,
+                due_before
+            ))
+
+            db.session.commit()
+
+        return [monitoring for monitoring in monitorings if monitoring.id in claimed_ids]
@@ -0,0 +1,161 @@
+from serverpatrol import app, db
+from models import *
+import threading
+import queue
+import json
+import time
+import sys
+
+
+def get_max_subscribers():
+    """Maximum number of opened streams per process (None if unlimited). Each one holds a thread (or an async core) of
+    the process for as long as the page is opened, so unless configured, at most half of the uWSGI threads or async
+    cores are used for streaming, which leaves the other half to the regular requests. A uWSGI process without threads
+    doesn't stream at all: the statuses pages fall back to polling the API."""
+    if app.config['STREAM_MAX_SUBSCRIBERS'] is not None:
+        return app.config['STREAM_MAX_SUBSCRIBERS']
+
+    uwsgi = sys.modules.get('uwsgi') # Embedded by uWSGI (not to be confused with our uwsgi.py)
+
+    if not hasattr(uwsgi, 'opt'): # Development server, which uses a thread per request
+        return None
+
+    cores = 1
+
+    for option in ('gevent', 'async', 'threads'):
+        value = uwsgi.opt.get(option)
+
+        if isinstance(value, list): # Option given several times
+            value = value[-1]
+
+        if value:
+            cores = int(value)
+
+            break
+
+    return cores // 2
+
+
+class Subscriber:
+    def __init__(self, authenticated):
+        self.authenticated = authenticated
+        self.events = queue.Queue(maxsize=100)
+        self.disconnected = False
+
+    def stream(self, keepalive_interval):
+        """Yield the events as Server-Sent Events messages."""
+        try:
+            yield 'retry: 5000\n\n'
+
+            while not self.disconnected:
+                try:
+                    event = self.events.get(timeout=keepalive_interval)
+                except queue.Empty:
+                    yield ': keep-alive\n\n' # Also lets the server notice disconnected clients
+
+                    continue
+
+                yield 'event: status\ndata: {}\n\n'.format(json.dumps(event))
+        finally:
+            broadcaster.unsubscribe(self)
+
+
+class StatusBroadcaster:
+    """Push the status transitions of the monitorings to the subscribed clients (the /stream route).
+
+    A single thread per process watches the signal file touched by the checker when a status changes (see
+    notify_statuses_changed()), and only then queries the monitorings modified since the last known revision. Each
+    transition is then fanned out to every subscriber, so the cost doesn't depend on the number of connected clients."""
+    def __init__(self, poll_interval, max_subscribers):
+        self.poll_interval = poll_interval
+        self.max_subscribers = max_subscribers
+
+        self.lock = threading.Lock()
+        self.subscribers = set()
+        self.thread = None
+        self.statuses = {} # Monitoring ID => last known status
+        self.revision = None
+        self.signal_mtime = None
+
+    def subscribe(self, authenticated):
+        """Return None if the maximum number of subscribers is reached."""
+        subscriber = Subscriber(authenticated)
+
+        with self.lock:
+            if self.max_subscribers is not None and len(self.subscribers) >= self.max_subscribers:
+                return None
+
+            self.subscribers.add(subscriber)
+
+            if not self.thread:
+                self.thread = threading.Thread(target=self.run, name='stream', daemon=True)
+                self.thread.start()
+
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+
+    def run(self):
+        with app.app_context():
+            while True:
+                try:
+                    self.poll()
+                except Exception as e:
+                    app.logger.exception('Error while polling the status changes: {}'.format(e))
+                finally:
+                    db.session.remove()
+
+                time.sleep(self.poll_interval)
+
+    def poll(self):
+        with self.lock:
+            if not self.subscribers:
+                self.revision = None # Nobody listens: start over from the current state when someone subscribes again
+
+                return
+
+        signal_mtime = get_statuses_changed_mtime()
+
+        if self.revision is not None and signal_mtime == self.signal_mtime:
+            return
+
+        self.signal_mtime = signal_mtime
+
+        q = Monitoring.query.filter(Monitoring.is_active == True)
+
+        if self.revision is not None:
+            q = q.filter(Monitoring.revision > self.revision)
+
+        monitorings = q.all()
+        initial = self.revision is None
+
+        self.revision = max([monitoring.revision for monitoring in monitorings], default=self.revision or 0)
+
+        for monitoring in monitorings:
+            if not initial and self.statuses.get(monitoring.id) != monitoring.status:
+                event = monitoring.to_dict()
+                event['status_icon'] = monitoring.status_icon
+
+                self.broadcast(event)
+
+            self.statuses[monitoring.id] = monitoring.status
+
+    def broadcast(self, event):
+        with self.lock:
+            subscribers = list(self.subscribers)
+
+        for subscriber in subscribers:
+            if not event['is_public'] and not subscriber.authenticated:
+                continue
+
+            try:
+                subscriber.events.put_nowait(event)
+            except queue.Full: # Client too slow to consume its events: disconnect it
+                subscriber.disconnected = True
+
+                self.unsubscribe(subscriber)
+
+
+broadcaster = StatusBroadcaster(app.config['STREAM_POLL_INTERVAL'], get_max_subscribers())
@@ -1,3 +1,3 @@
-from serverpatrol import app
+from web import app
 
 app.run(host='0.0.0.0', port=8080, threaded=True)
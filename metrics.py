@@ -0,0 +1,229 @@
+from collections import defaultdict, OrderedDict
+from contextlib import contextmanager
+import threading
+import logging
+import json
+import time
+import os
+
+METRICS_FILE = 'storage/data/metrics.json'
+LOCK_TIMEOUT = 10 # Seconds after which a lock left by a crashed process is broken
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+# Name => (type, help)
+METRICS = OrderedDict([
+    ('serverpatrol_tick_duration_seconds', ('histogram', 'Time taken by a run of flask check.')),
+    ('serverpatrol_tick_overruns_total', ('counter', 'Number of runs of flask check which started a check after the next run began.')),
+    ('serverpatrol_tick_phase_duration_seconds', ('histogram', 'Time spent in each phase of a run of flask check or of a batch of checks performed by flask patrol.')),
+    ('serverpatrol_check_lateness_seconds', ('histogram', 'Delay between the time a check was due and the time it started.')),
+    ('serverpatrol_checks_total', ('counter', 'Number of checks performed, per resulting status.')),
+    ('serverpatrol_check_retries_total', ('counter', 'Number of failed probes retried right away.')),
+    ('serverpatrol_check_duration_seconds', ('histogram', 'Duration of the HTTP requests of the checks, per monitoring.')),
+    ('serverpatrol_probe_phase_duration_seconds', ('histogram', 'Time spent resolving the host name, connecting, in the TLS handshake, until the first byte and matching the response body, when CHECKS_MEASURE_TIMINGS is enabled.')),
+    ('serverpatrol_coalesced_probes_total', ('counter', 'Number of probes not performed because an identical one was pending, whose result they got.')),
+    ('serverpatrol_dns_lookups_total', ('counter', 'Number of host name resolutions, per result in the DNS cache (hit, negative_hit or miss).')),
+    ('serverpatrol_alerts_total', ('counter', 'Number of alerts sent, per channel and outcome.')),
+    ('serverpatrol_alert_send_duration_seconds', ('histogram', 'Time taken to send an alert, per channel.'))
+])
+
+
+tick_logger = logging.getLogger('serverpatrol.ticks')
+
+
+def log_tick(**fields):
+    """Write a record to the structured log of the checker (storage/logs/ticks.log), as a line of JSON."""
+    tick_logger.info(json.dumps(fields, default=str))
+
+
+def get_key(name, labels):
+    return (name, tuple(sorted(labels.items())))
+
+
+def is_monitoring_kept(key, monitorings):
+    """Whether the series identified by key isn't specific to a monitoring, or belongs to one of the given monitorings
+    (name by ID) under its current name."""
+    labels = dict(key[1])
+
+    if 'monitoring_id' not in labels:
+        return True
+
+    return monitorings.get(labels['monitoring_id']) == labels.get('monitoring')
+
+
+class Metrics:
+    """Counters and histograms of the checker, kept in memory then merged into METRICS_FILE by flush() so the web app
+    can serve them (see the /metrics route). Thread-safe."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = defaultdict(float) # (name, labels) => value
+        self.histograms = {} # (name, labels) => [count per bucket..., count above the last bucket, sum]
+
+    def inc(self, name, value=1, **labels):
+        with self.lock:
+            self.counters[get_key(name, labels)] += value
+
+    def observe(self, name, value, **labels):
+        key = get_key(name, labels)
+
+        with self.lock:
+            histogram = self.histograms.setdefault(key, [0] * (len(DURATION_BUCKETS) + 2))
+
+            histogram[next((i for i, bound in enumerate(DURATION_BUCKETS) if value <= bound), len(DURATION_BUCKETS))] += 1
+            histogram[-1] += value
+
+    @contextmanager
+    def time(self, name, **labels):
+        start = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def flush(self, monitorings=None):
+        """Add the metrics collected since the previous call to the ones in METRICS_FILE. If monitorings (name by ID) is
+        given, the series of the other monitorings (deleted, deactivated or renamed since) are removed from the file."""
+        with self.lock:
+            counters, self.counters = self.counters, defaultdict(float)
+            histograms, self.histograms = self.histograms, {}
+
+        if not counters and not histograms:
+            return
+
+        with locked(METRICS_FILE):
+            snapshot = load_snapshot()
+
+            for key, value in counters.items():
+                snapshot['counters'][key] = snapshot['counters'].get(key, 0) + value
+
+            for key, histogram in histograms.items():
+                existing = snapshot['histograms'].get(key, [0] * len(histogram))
+
+                snapshot['histograms'][key] = [a + b for a, b in zip(existing, histogram)]
+
+            if monitorings is not None:
+                for kind in ('counters', 'histograms'):
+                    snapshot[kind] = {key: value for key, value in snapshot[kind].items() if is_monitoring_kept(key, monitorings)}
+
+            save_snapshot(snapshot)
+
+
+metrics = Metrics()
+
+
+@contextmanager
+def locked(path):
+    """Hold an exclusive lock on the given file, shared with the other processes, for the duration of the context."""
+    lock_path = path + '.lock'
+    start = time.monotonic()
+
+    while True:
+        try:
+            os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(lock_path) > LOCK_TIMEOUT:
+                    os.remove(lock_path)
+
+                    continue
+            except OSError: # Released in the meantime
+                continue
+
+            if time.monotonic() - start > LOCK_TIMEOUT:
+                raise TimeoutError('Unable to lock ' + path)
+
+            time.sleep(0.01)
+
+    try:
+        yield
+    finally:
+        os.remove(lock_path)
+
+
+def load_snapshot():
+    try:
+        with open(METRICS_FILE, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        data = {'counters': [], 'histograms': []}
+
+    return {
+        kind: {get_key(name, labels): value for name, labels, value in data[kind]} for kind in ('counters', 'histograms')
+    }
+
+
+def save_snapshot(snapshot):
+    data = {
+        kind: [[name, dict(labels), value] for (name, labels), value in snapshot[kind].items()] for kind in ('counters', 'histograms')
+    }
+
+    with open(METRICS_FILE + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+
+    os.replace(METRICS_FILE + '.tmp', METRICS_FILE) # Readers never see a partially written file
+
+
+def format_labels(labels, **extra):
+    labels = list(labels) + list(extra.items())
+
+    if not labels:
+        return ''
+
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for name, value in labels) + '}'
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+def render_prometheus():
+    """Render the metrics of METRICS_FILE in the Prometheus text exposition format."""
+    snapshot = load_snapshot()
+    lines = []
+
+    for name, (kind, description) in METRICS.items():
+        lines.append('# HELP {} {}'.format(name, description))
+        lines.append('# TYPE {} {}'.format(name, kind))
+
+        if kind == 'counter':
+            for (metric_name, labels), value in sorted(snapshot['counters'].items()):
+                if metric_name == name:
+                    lines.append('{}{} {}'.format(name, format_labels(labels), format_value(value)))
+        else:
+            for (metric_name, labels), histogram in sorted(snapshot['histograms'].items()):
+                if metric_name != name:
+                    continue
+
+                cumulated = 0
+
+                for bound, count in zip(DURATION_BUCKETS + ('+Inf',), histogram[:-1]):
+                    cumulated += count
+
+                    lines.append('{}_bucket{} {}'.format(name, format_labels(labels, le=bound), cumulated))
+
+                lines.append('{}_sum{} {}'.format(name, format_labels(labels), format_value(histogram[-1])))
+                lines.append('{}_count{} {}'.format(name, format_labels(labels), cumulated))
+
+    return '\n'.join(lines) + '\n'
+
+
+class PhaseTimer:
+    """Measure the total time spent in each phase of a piece of work, phases possibly being entered several times."""
+    def __init__(self):
+        self.durations = OrderedDict()
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self.durations[name] = self.durations.get(name, 0) + time.perf_counter() - start
+
+    def observe(self):
+        for phase, duration in self.durations.items():
+            metrics.observe('serverpatrol_tick_phase_duration_seconds', duration, phase=phase)
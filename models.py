@@ -1,16 +1,112 @@
+from sqlalchemy import update, select, insert, func, event, inspect, or_, union_all, TypeDecorator
 from sqlalchemy_utils import ArrowType
-from serverpatrol import db, auth
+from sqlalchemy.orm import validates
+from sketches import DurationSketch
+from serverpatrol import app, db, auth
 from enum import Enum
+import hashlib
 import arrow
+import math
 import json
+import os
 
 
 __all__ = [
     'MonitoringHttpMethod',
     'MonitoringStatus',
-    'Monitoring'
+    'Monitoring',
+    'MonitoringSnapshot',
+    'MonitoringRemoval',
+    'Check',
+    'CheckRollupPeriod',
+    'CheckRollup',
+    'notify_monitorings_changed',
+    'get_monitorings_changed_mtime',
+    'notify_statuses_changed',
+    'get_statuses_changed_mtime'
 ]
 
+MONITORINGS_CHANGED_FILE = 'storage/.monitorings_changed'
+STATUSES_CHANGED_FILE = 'storage/.statuses_changed'
+
+
+def _touch(path):
+    with open(path, 'a'):
+        os.utime(path)
+
+
+def _get_mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+
+def notify_monitorings_changed():
+    """Let the patrol daemon know the monitorings have been modified so it reloads them."""
+    _touch(MONITORINGS_CHANGED_FILE)
+
+
+def get_monitorings_changed_mtime():
+    return _get_mtime(MONITORINGS_CHANGED_FILE)
+
+
+def notify_statuses_changed():
+    """Let the web app know the status of at least one monitoring changed."""
+    _touch(STATUSES_CHANGED_FILE)
+
+
+def get_statuses_changed_mtime():
+    return _get_mtime(STATUSES_CHANGED_FILE)
+
+
+def _hash_fraction(value):
+    """Deterministic pseudo-random number in [0, 1) derived from the given string, the same in every process."""
+    digest = hashlib.md5(value.encode('utf-8')).digest()
+
+    return int.from_bytes(digest[:8], 'big') / 2 ** 64
+
+
+def _get_next_check(key, after, interval, max_jitter):
+    """First check time slot of the monitoring identified by key that is strictly after the given date.
+
+    Slots are interval seconds apart, shifted by a per-monitoring offset so monitorings having the same interval are
+    spread evenly over it instead of all being due at the same time. Each slot is then moved by a pseudo-random jitter
+    of at most max_jitter seconds (and at most a tenth of the interval)."""
+    if not interval or interval <= 0: # Invalid interval stored before it was validated: check every minute
+        interval = 60
+
+    offset = _hash_fraction(key) * interval
+    slot = math.floor((after.float_timestamp - offset) / interval) + 1
+    max_jitter = min(max_jitter, interval / 10)
+
+    while True:
+        jitter = (2 * _hash_fraction('{}:{}'.format(key, slot)) - 1) * max_jitter
+        next_check = offset + slot * interval + jitter
+
+        if next_check > after.float_timestamp: # The jitter may have moved the slot back before the date
+            return arrow.get(next_check).to(after.tzinfo)
+
+        slot += 1
+
+
+class JsonText(TypeDecorator):
+    """JSON document stored in a TEXT column. It is decoded once when the row is loaded instead of each time the
+    attribute is accessed. Changes made in place aren't detected: assign a new value instead."""
+    impl = db.Text
+    cache_ok = True
+
+    def __init__(self, empty, *args, **kwargs):
+        self.empty = empty # Type of the value of an empty column
+
+        super().__init__(*args, **kwargs)
+
+    def process_bind_param(self, value, dialect):
+        return json.dumps(value if value is not None else self.empty())
+
+    def process_result_value(self, value, dialect):
+        return json.loads(value) if value else self.empty()
+
 
 class MonitoringHttpMethod(Enum):
     GET = 'GET'
@@ -26,31 +122,111 @@ class MonitoringStatus(Enum):
     DOWN = 'DOWN'
 
 
+PROBLEMS_FIRST = (MonitoringStatus.DOWN, MonitoringStatus.UNKNOWN, MonitoringStatus.UP)
+
+
+class CheckRollupPeriod(Enum):
+    HOUR = 'HOUR'
+    DAY = 'DAY'
+
+
 class Monitoring(db.Model):
     class MonitoringQuery(db.Query):
-        def get_for_home(self):
+        def get_for_home(self, since=None):
             q = self.order_by(Monitoring.name.asc())
 
-            q = q.filter(Monitoring.is_active == True)
+            q = q.filter_for_home()
 
-            if auth.username() == '' or auth.username() == None:
-                q = q.filter(Monitoring.is_public == True)
+            if since is not None: # Only the monitorings modified after the given revision
+                q = q.filter(Monitoring.revision > since)
 
             return q.all()
 
-        def get_for_managing(self):
-            q = self.order_by(Monitoring.name.asc())
+        def filter_for_home(self):
+            q = self.filter(Monitoring.is_active == True)
 
-            return q.all()
+            if not auth.current_user(): # Credentials are only verified by views decorated with auth.login_required
+                q = q.filter(Monitoring.is_public == True)
 
-        def get_for_checking(self):
-            q = self.order_by(Monitoring.name.asc())
+            return q
 
-            q = q.filter(Monitoring.is_active == True)
+        def filter_by_criteria(self, status=None, is_active=None, is_public=None, search=None):
+            """Only the monitorings having the given status, active or public flag, and whose name contains the given
+            text (case-insensitive), when given."""
+            q = self
 
-            return q.all()
+            if status is not None:
+                q = q.filter(Monitoring.status == status)
+
+            if is_active is not None:
+                q = q.filter(Monitoring.is_active == is_active)
+
+            if is_public is not None:
+                q = q.filter(Monitoring.is_public == is_public)
+
+            if search:
+                q = q.filter(Monitoring.name.icontains(search, autoescape=True))
+
+            return q
+
+        def get_page(self, order='name', after=None, limit=50):
+            """Return a page of at most limit monitorings sorted by name or, if order is 'problems', by status (DOWN,
+            UNKNOWN then UP) then name. Also return the cursor of the next page, a (status, name) tuple to pass as after
+            to get it, or None if this is the last page.
+
+            Pages are fetched by seeking the ix_monitorings_status_name (or name) index from the cursor instead of
+            skipping rows, so getting any page costs the same whatever the number of monitorings."""
+            after_status, after_name = after or (None, None)
+
+            if order == 'problems':
+                statuses = PROBLEMS_FIRST[PROBLEMS_FIRST.index(after_status):] if after_status else PROBLEMS_FIRST
+                monitorings = []
+
+                for status in statuses:
+                    q = self.filter(Monitoring.status == status)
+
+                    if status == after_status:
+                        q = q.filter(Monitoring.name > after_name)
+
+                    monitorings.extend(q.order_by(Monitoring.name.asc()).limit(limit + 1 - len(monitorings)))
+
+                    if len(monitorings) > limit:
+                        break
+            else:
+                q = self.filter(Monitoring.name > after_name) if after_name is not None else self
+
+                monitorings = q.order_by(Monitoring.name.asc()).limit(limit + 1).all()
+
+            if len(monitorings) <= limit:
+                return monitorings, None
+
+            monitorings = monitorings[:limit]
+
+            return monitorings, (monitorings[-1].status, monitorings[-1].name)
+
+        def get_for_checking(self, due_before=None):
+            """Return the active monitorings as MonitoringSnapshot instances. If due_before is given, only the ones whose
+            next check is before this date, using the ix_monitorings_is_active_next_check_at index."""
+            q = self.filter(Monitoring.is_active == True)
+
+            if due_before is not None:
+                q = q.filter(Monitoring.next_check_at < due_before).order_by(Monitoring.next_check_at.asc())
+            else:
+                q = q.order_by(Monitoring.name.asc())
+
+            q = q.with_entities(*[getattr(Monitoring, column) for column in MonitoringSnapshot.COLUMNS])
+
+            return [MonitoringSnapshot(row) for row in q]
+
+        def get_active_names(self):
+            """Return the name of the active monitorings, by ID."""
+            return dict(self.filter(Monitoring.is_active == True).with_entities(Monitoring.id, Monitoring.name))
 
     __tablename__ = 'monitorings'
+    __table_args__ = (
+        db.Index('ix_monitorings_is_active_next_check_at', 'is_active', 'next_check_at'),
+        db.Index('ix_monitorings_status_name', 'status', 'name')
+    )
     query_class = MonitoringQuery
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
@@ -60,23 +236,110 @@ class Monitoring(db.Model):
     is_public = db.Column(db.Boolean, default=False)
     url = db.Column(db.String(255), nullable=False)
     http_method = db.Column(db.Enum(MonitoringHttpMethod), default=MonitoringHttpMethod.GET)
-    _http_headers = db.Column('http_headers', db.Text, default={})
+    http_headers = db.Column(JsonText(dict), default=dict)
     http_body_regex = db.Column(db.String(255), default=None)
+    http_body_max_bytes = db.Column(db.Integer, default=None) # None: use HTTP_BODY_MAX_BYTES
     verify_https_cert = db.Column(db.Boolean, default=True)
     check_interval = db.Column(db.Integer, default=5)
+    down_check_interval = db.Column(db.Integer, default=None) # Minutes. None: use check_interval while DOWN as well
     timeout = db.Column(db.Integer, default=10)
     last_checked_at = db.Column(ArrowType, default=None)
+    next_check_at = db.Column(ArrowType, default=None) # Stored value of next_check, kept up to date by update_next_check_at() and the checker
     last_status_change_at = db.Column(ArrowType, default=None)
     status = db.Column(db.Enum(MonitoringStatus), default=MonitoringStatus.UNKNOWN)
     last_down_reason = db.Column(db.Text, default='')
-    _email_recipients = db.Column('email_recipients', db.Text, default=[])
-    _sms_recipients = db.Column('sms_recipients', db.Text, default=[])
+    email_recipients = db.Column(JsonText(list), default=list)
+    sms_recipients = db.Column(JsonText(list), default=list)
     created_at = db.Column(ArrowType, default=arrow.now())
     ignore_http_errors = db.Column(db.Boolean, default=False)
+    down_confirmations = db.Column(db.Integer, default=1) # Number of consecutive failed checks before going DOWN
+    up_confirmations = db.Column(db.Integer, default=1) # Number of consecutive successful checks before going back UP
+    retries = db.Column(db.Integer, default=0) # Number of times a failed check is retried right away, while UP
+    unconfirmed_checks_count = db.Column(db.Integer, default=0) # Consecutive checks whose result differs from the current status
+    revision = db.Column(db.Integer, nullable=False, default=0, index=True) # Incremented each time the monitoring is checked or modified
+    lease_owner = db.Column(db.String(255), default=None) # Checker process currently checking the monitoring (see leases.py)
+    lease_expires_at = db.Column(ArrowType, default=None)
+
+    checks = db.relationship('Check', backref='monitoring', lazy='dynamic', order_by='Check.date_time', passive_deletes=True)
+    check_rollups = db.relationship('CheckRollup', backref='monitoring', lazy='dynamic', order_by='CheckRollup.date_time', passive_deletes=True)
 
     def __repr__(self):
         return '<Monitoring> #{} : {}'.format(self.id, self.name)
 
+    @staticmethod
+    def get_next_revision():
+        """SQL expression of a revision greater than any existing one, of a monitoring or of a removal (see
+        MonitoringRemoval)."""
+        revisions = union_all(
+            select(func.max(Monitoring.revision).label('revision')),
+            select(func.max(MonitoringRemoval.revision).label('revision'))
+        ).subquery()
+
+        return select(func.coalesce(func.max(revisions.c.revision), 0) + 1).scalar_subquery()
+
+    @staticmethod
+    def bump_revision(ids):
+        """Give the given monitorings a revision greater than any existing one. Computed in a single statement so
+        concurrent writers can't give the same revision to different changes."""
+        if not ids:
+            return
+
+        db.session.execute(
+            update(Monitoring).where(Monitoring.id.in_(ids)).values(
+                revision=Monitoring.get_next_revision()
+            ).execution_options(synchronize_session=False)
+        )
+
+    @staticmethod
+    def claim(ids, owner, lease_expires_at, now, due_before=None):
+        """Lease the given monitorings to owner, except the ones leased to another owner whose lease isn't expired yet
+        and, if due_before is given, the ones whose next check is not before this date. Return the IDs of the claimed
+        monitorings.
+
+        The conditions are evaluated by the UPDATE statement itself, so when several processes try to claim the same
+        monitoring only one of them succeeds. The caller is responsible for committing."""
+        if not ids:
+            return set()
+
+        statement = update(Monitoring).where(
+            Monitoring.id.in_(ids),
+            or_(Monitoring.lease_owner == None, Monitoring.lease_owner == owner, Monitoring.lease_expires_at < now)
+        )
+
+        if due_before is not None:
+            statement = statement.where(Monitoring.next_check_at < due_before)
+
+        db.session.execute(
+            statement.values(lease_owner=owner, lease_expires_at=lease_expires_at).execution_options(synchronize_session=False)
+        )
+
+        return {
+            monitoring_id for monitoring_id, in db.session.query(Monitoring.id).filter(Monitoring.id.in_(ids), Monitoring.lease_owner == owner)
+        }
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'url': self.url,
+            'is_public': self.is_public,
+            'status': self.status.value,
+            'last_down_reason': self.last_down_reason if self.status == MonitoringStatus.DOWN else None,
+            'last_status_change_at': self.last_status_change_at.isoformat() if self.last_status_change_at else None,
+            'last_checked_at': self.last_checked_at.isoformat() if self.last_checked_at else None,
+            'next_check': self.next_check.isoformat(),
+            'revision': self.revision
+        }
+
+    @property
+    def current_check_interval(self):
+        """Check interval in minutes, shortened to down_check_interval (if set) while DOWN or while a status change
+        is being confirmed."""
+        if self.down_check_interval and (self.status == MonitoringStatus.DOWN or self.unconfirmed_checks_count):
+            return min(self.down_check_interval, self.check_interval)
+
+        return self.check_interval
+
     @property
     def next_check(self):
         if self.last_checked_at:
@@ -84,7 +347,7 @@ class Monitoring(db.Model):
         else:
             attr = self.created_at
 
-        return attr.floor('minute').shift(minutes=self.check_interval)
+        return _get_next_check(self.name, attr, self.current_check_interval * 60, app.config['CHECKS_JITTER'])
 
     @property
     def status_icon(self):
@@ -95,39 +358,222 @@ class Monitoring(db.Model):
         elif self.status == MonitoringStatus.UNKNOWN:
             return 'question'
 
-    @property
-    def http_headers(self):
-        return json.loads(self._http_headers) if self._http_headers else {}
+    @validates('http_headers', 'email_recipients', 'sms_recipients')
+    def validate_json(self, key, value):
+        if isinstance(value, str): # Submitted by the form as a JSON string
+            return json.loads(value) if value else None
 
-    @http_headers.setter
-    def http_headers(self, value):
-        if isinstance(value, str):
-            self._http_headers = value
-        else:
-            self._http_headers = json.dumps(value)
+        return value
 
     @property
-    def email_recipients(self):
-        return json.loads(self._email_recipients) if self._email_recipients else []
+    def request_duration_data(self):
+        return [[check.date_time.timestamp * 1000, check.request_duration] for check in self.checks]
 
-    @email_recipients.setter
-    def email_recipients(self, value):
-        if isinstance(value, str):
-            self._email_recipients = value
-        else:
-            self._email_recipients = json.dumps(value)
 
-    @property
-    def sms_recipients(self):
-        return json.loads(self._sms_recipients) if self._sms_recipients else []
+@event.listens_for(Monitoring, 'before_insert')
+@event.listens_for(Monitoring, 'before_update')
+def update_next_check_at(mapper, connection, monitoring):
+    if not monitoring.created_at:
+        monitoring.created_at = arrow.now()
+
+    if monitoring.check_interval is None: # Column defaults are only applied after this listener runs
+        monitoring.check_interval = Monitoring.check_interval.default.arg
+
+    monitoring.next_check_at = monitoring.next_check
+
+
+def _get_previous_value(monitoring, attribute):
+    """Value of an attribute of the monitoring before the changes being flushed."""
+    history = inspect(monitoring).attrs[attribute].history
+
+    return history.deleted[0] if history.deleted else getattr(monitoring, attribute)
+
 
-    @sms_recipients.setter
-    def sms_recipients(self, value):
-        if isinstance(value, str):
-            self._sms_recipients = value
+def _record_removal(connection, monitoring, is_active, is_public):
+    """Record a MonitoringRemoval if the statuses page won't show the monitoring anymore to some of the users it was
+    shown to, now that it is (or isn't, if it is deleted) active and public as given."""
+    was_active = _get_previous_value(monitoring, 'is_active')
+    was_public = _get_previous_value(monitoring, 'is_public')
+
+    if not was_active or (is_active and (is_public or not was_public)): # Still shown to the same users
+        return
+
+    connection.execute(insert(MonitoringRemoval).values(
+        monitoring_id=monitoring.id,
+        revision=Monitoring.get_next_revision(),
+        was_public=bool(was_public),
+        public_only=bool(is_active)
+    ))
+
+
+@event.listens_for(Monitoring, 'after_update')
+def record_hiding(mapper, connection, monitoring):
+    _record_removal(connection, monitoring, monitoring.is_active, monitoring.is_public)
+
+
+@event.listens_for(Monitoring, 'after_delete')
+def record_deletion(mapper, connection, monitoring):
+    _record_removal(connection, monitoring, False, False)
+
+
+class MonitoringRemoval(db.Model):
+    """A monitoring the statuses page stopped showing, because it was deleted, deactivated or made private. Lets the
+    clients of the JSON API polling the changes (see Monitoring.revision) remove it."""
+    __tablename__ = 'monitoring_removals'
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+
+    monitoring_id = db.Column(db.Integer, nullable=False) # No foreign key, as the monitoring may be deleted
+    revision = db.Column(db.Integer, nullable=False, index=True) # Same sequence as Monitoring.revision
+    was_public = db.Column(db.Boolean, nullable=False) # Whether it was shown to the users without credentials
+    public_only = db.Column(db.Boolean, nullable=False) # Whether it is still shown to the users with credentials (made private)
+
+    def __repr__(self):
+        return '<MonitoringRemoval> #{} : {}'.format(self.monitoring_id, self.revision)
+
+    @staticmethod
+    def get_for_home(since):
+        """The removals after the given revision concerning the current user (see MonitoringQuery.filter_for_home())."""
+        q = MonitoringRemoval.query.filter(MonitoringRemoval.revision > since)
+
+        if auth.current_user():
+            q = q.filter(MonitoringRemoval.public_only == False)
         else:
-            self._sms_recipients = json.dumps(value)
+            q = q.filter(MonitoringRemoval.was_public == True)
+
+        return q.order_by(MonitoringRemoval.revision.asc()).all()
+
+
+class MonitoringSnapshot:
+    """Compact copy of the columns of a monitoring the checker works from, without the ORM instance state. It is
+    updated by process_result() then saved using bulk_update_mappings() (see to_mapping())."""
+    COLUMNS = (
+        'id',
+        'name',
+        'url',
+        'http_method',
+        'http_headers',
+        'http_body_regex',
+        'http_body_max_bytes',
+        'verify_https_cert',
+        'check_interval',
+        'down_check_interval',
+        'timeout',
+        'ignore_http_errors',
+        'down_confirmations',
+        'up_confirmations',
+        'retries',
+        'email_recipients',
+        'sms_recipients',
+        'status',
+        'last_down_reason',
+        'unconfirmed_checks_count',
+        'last_checked_at',
+        'last_status_change_at',
+        'created_at'
+    )
+
+    __slots__ = COLUMNS + ('status_changed',)
+
+    def __init__(self, row):
+        for column, value in zip(self.COLUMNS, row):
+            setattr(self, column, value)
+
+        self.status_changed = False
+
+    def __repr__(self):
+        return '<MonitoringSnapshot> #{} : {}'.format(self.id, self.name)
+
+    current_check_interval = Monitoring.current_check_interval
+    next_check = Monitoring.next_check
+
+    def to_mapping(self):
+        """The columns updated by the checker. The lease is released at the same time."""
+        return {
+            'id': self.id,
+            'status': self.status,
+            'last_down_reason': self.last_down_reason,
+            'unconfirmed_checks_count': self.unconfirmed_checks_count,
+            'last_checked_at': self.last_checked_at,
+            'next_check_at': self.next_check,
+            'last_status_change_at': self.last_status_change_at,
+            'lease_owner': None,
+            'lease_expires_at': None
+        }
+
+
+class Check(db.Model):
+    __tablename__ = 'checks'
+    __table_args__ = (
+        db.Index('ix_checks_monitoring_id_date_time', 'monitoring_id', 'date_time'),
+        db.Index('ix_checks_date_time', 'date_time')
+    )
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+
+    monitoring_id = db.Column(db.Integer, db.ForeignKey('monitorings.id', ondelete='CASCADE'), nullable=False)
+    date_time = db.Column(ArrowType, nullable=False)
+    status = db.Column(db.Enum(MonitoringStatus), nullable=False)
+    http_status_code = db.Column(db.SmallInteger, default=None)
+    request_duration = db.Column(db.Integer, default=None) # Milliseconds
+    connect_duration = db.Column(db.Integer, default=None) # Milliseconds, only set if CHECKS_MEASURE_TIMINGS is enabled. Includes the DNS resolution and TLS handshake. 0 if the connection was reused
+    ttfb_duration = db.Column(db.Integer, default=None) # Milliseconds, only set if CHECKS_MEASURE_TIMINGS is enabled. Includes connect_duration
+    down_reason = db.Column(db.Text, default=None) # Only set when status is DOWN
+
+    def __repr__(self):
+        return '<Check> #{} : {} {}'.format(self.id, self.date_time, self.status.value)
+
+
+class CheckRollup(db.Model):
+    __tablename__ = 'check_rollups'
+    __table_args__ = (
+        db.UniqueConstraint('monitoring_id', 'period', 'date_time', name='uq_check_rollups_monitoring_id_period_date_time'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+
+    monitoring_id = db.Column(db.Integer, db.ForeignKey('monitorings.id', ondelete='CASCADE'), nullable=False)
+    period = db.Column(db.Enum(CheckRollupPeriod), nullable=False)
+    date_time = db.Column(ArrowType, nullable=False) # Start of the period, in UTC
+    checks_count = db.Column(db.Integer, nullable=False, default=0)
+    up_count = db.Column(db.Integer, nullable=False, default=0)
+    request_duration_min = db.Column(db.Integer, default=None) # Request durations are those of the UP checks, in milliseconds
+    request_duration_sum = db.Column(db.BigInteger, nullable=False, default=0)
+    request_duration_max = db.Column(db.Integer, default=None)
+    request_duration_sketch = db.Column(JsonText(dict), default=dict) # Buckets of a DurationSketch
+
+    def __repr__(self):
+        return '<CheckRollup> #{} : {} {}'.format(self.id, self.period.value, self.date_time)
+
+    def add_checks(self, checks):
+        """Account the given checks (as mappings) in this rollup. Only UP checks are taken into account for the request
+        durations, as the ones of the DOWN checks are mostly timeouts."""
+        sketch = DurationSketch(self.request_duration_sketch)
+
+        for check in checks:
+            self.checks_count = (self.checks_count or 0) + 1
+
+            if check['status'] != MonitoringStatus.UP or check['request_duration'] is None:
+                continue
+
+            duration = check['request_duration']
+
+            self.up_count = (self.up_count or 0) + 1
+            self.request_duration_min = min(self.request_duration_min, duration) if self.request_duration_min is not None else duration
+            self.request_duration_sum = (self.request_duration_sum or 0) + duration
+            self.request_duration_max = max(self.request_duration_max, duration) if self.request_duration_max is not None else duration
+
+            sketch.add(duration)
+
+        self.request_duration_sketch = sketch.buckets
 
     @property
-    def request_duration_data(self):
-        return [[check.date_time.timestamp * 1000, check.request_duration] for check in self.checks]
+    def uptime_ratio(self):
+        return self.up_count / self.checks_count if self.checks_count else None
+
+    @property
+    def request_duration_avg(self):
+        return round(self.request_duration_sum / self.up_count) if self.up_count else None
+
+    def request_duration_percentile(self, p):
+        return DurationSketch(self.request_duration_sketch).quantile(p / 100)
@@ -1,21 +1,93 @@
-from flask import render_template, abort, redirect, url_for, flash, g, Response
-from serverpatrol import app, auth, db
+from flask import render_template, abort, redirect, url_for, flash, g, request, session, jsonify, Response, stream_with_context
 from flask_babel import _, format_datetime
+from serverpatrol import app, auth, db
+from metrics import render_prometheus
+from cache import cached_response
+from history import get_reports
+from live import broadcaster
 from models import *
 from forms import *
 import PyRSS2Gen
+import base64
 import arrow
+import bulk
+import json
 
 
 @app.route('/')
+@auth.login_required(optional=True)
 def home():
-    return render_template('home.html', monitorings=Monitoring.query.get_for_home())
+    if request.args: # Filtered or not the first page: not worth caching
+        return render_home()
+
+    if session.get('_flashes'): # Messages pending for this user only, displayed by the layout
+        return render_home()
+
+    return cached_response(
+        ('home', bool(auth.current_user()), g.CURRENT_LOCALE),
+        render_home
+    )
+
+
+def render_home():
+    filter_form, monitorings, pagination = get_monitorings_page(Monitoring.query.filter_for_home(), 'problems', with_flags=False)
+
+    return render_template('home.html', monitorings=monitorings, filter_form=filter_form, pagination=pagination)
 
 
 @app.route('/admin')
 @auth.login_required
 def admin():
-    return render_template('admin/list.html', monitorings=Monitoring.query.get_for_managing())
+    filter_form, monitorings, pagination = get_monitorings_page(Monitoring.query, 'name')
+    reports = get_reports([monitoring.id for monitoring in monitorings], arrow.now())
+
+    return render_template('admin/list.html', monitorings=monitorings, reports=reports, filter_form=filter_form, pagination=pagination, import_form=ImportMonitoringsForm())
+
+
+def get_monitorings_page(q, default_order, with_flags=True):
+    """Filter the monitorings of q according to the query string, and return the filters form along with the requested
+    page of MONITORINGS_PER_PAGE monitorings and the URLs of the first and next pages (None if not applicable)."""
+    filter_form = MonitoringsFilterForm(request.args, order=default_order)
+
+    if not filter_form.validate():
+        abort(400)
+
+    monitorings, next_cursor = q.filter_by_criteria(**filter_form.get_criteria(with_flags)).get_page(
+        filter_form.order.data,
+        decode_cursor(request.args.get('after')),
+        app.config['MONITORINGS_PER_PAGE']
+    )
+
+    args = {name: value for name, value in request.args.items() if name != 'after'}
+
+    pagination = {
+        'first_url': url_for(request.endpoint, **args) if 'after' in request.args else None,
+        'next_url': url_for(request.endpoint, after=encode_cursor(next_cursor), **args) if next_cursor else None
+    }
+
+    return filter_form, monitorings, pagination
+
+
+def encode_cursor(cursor):
+    status, name = cursor
+
+    return base64.urlsafe_b64encode(json.dumps([status.value, name]).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(value):
+    """Decode a cursor encoded by encode_cursor(), aborting with a 400 error if it's invalid."""
+    if not value:
+        return None
+
+    try:
+        status, name = json.loads(base64.urlsafe_b64decode(value.encode('ascii')))
+
+        if not isinstance(name, str):
+            raise ValueError()
+
+        return MonitoringStatus(status), name
+    except (ValueError, TypeError):
+        abort(400)
 
 
 @app.route('/admin/create', methods=['GET', 'POST'])
@@ -30,8 +102,14 @@ def admin_create():
             form.populate_obj(monitoring)
 
             db.session.add(monitoring)
+            db.session.flush()
+
+            Monitoring.bump_revision([monitoring.id])
+
             db.session.commit()
 
+            notify_monitorings_changed()
+
             flash(_('Monitoring created successfuly.'), 'success')
 
             return redirect(url_for('admin_edit', monitoring_id=monitoring.id))
@@ -56,8 +134,14 @@ def admin_edit(monitoring_id):
             form.populate_obj(monitoring)
 
             db.session.add(monitoring)
+            db.session.flush()
+
+            Monitoring.bump_revision([monitoring.id])
+
             db.session.commit()
 
+            notify_monitorings_changed()
+
             flash(_('Monitoring edited successfuly.'), 'success')
 
             return redirect(url_for('admin_edit', monitoring_id=monitoring.id))
@@ -67,6 +151,47 @@ def admin_edit(monitoring_id):
     return render_template('admin/edit.html', monitoring=monitoring, form=form)
 
 
+@app.route('/admin/export.<any(jsonl, csv):format_>')
+@auth.login_required
+def admin_export(format_):
+    return Response(stream_with_context(bulk.export_monitorings(format_)), mimetype=bulk.MIMETYPES[format_], headers={
+        'Content-Disposition': 'attachment; filename=monitorings.' + format_
+    })
+
+
+@app.route('/admin/import', methods=['POST'])
+@auth.login_required
+def admin_import():
+    """Import monitorings either from the form of the admin, or from the request body (with the Content-Type of one of
+    bulk.MIMETYPES), in which case the result is returned as JSON."""
+    if request.mimetype != 'multipart/form-data':
+        format_ = next((format_ for format_, mimetype in bulk.MIMETYPES.items() if mimetype == request.mimetype), None)
+
+        if not format_:
+            abort(415)
+
+        return jsonify(bulk.import_stream(request.stream, format_, dry_run=request.args.get('dry_run') in ('1', 'true')))
+
+    form = ImportMonitoringsForm()
+
+    if not form.validate_on_submit():
+        flash(_('Please select a file to import.'), 'error')
+
+        return redirect(url_for('admin'))
+
+    result = bulk.import_stream(form.file.data.stream, bulk.get_format(form.file.data.filename), max_errors=10)
+
+    for error in result['errors']:
+        flash(_('Line %(line_number)i: %(errors)s', line_number=error['line'], errors=bulk.format_errors(error['errors'])), 'error')
+
+    flash(
+        _('%(created)i monitorings created, %(updated)i updated, %(unchanged)i unchanged, %(invalid)i invalid.', created=result['created'], updated=result['updated'], unchanged=result['unchanged'], invalid=result['invalid']),
+        'success' if not result['invalid'] else 'error'
+    )
+
+    return redirect(url_for('admin'))
+
+
 @app.route('/admin/delete/<monitoring_id>')
 @auth.login_required
 def admin_delete(monitoring_id):
@@ -79,6 +204,8 @@ def admin_delete(monitoring_id):
         db.session.delete(monitoring)
         db.session.commit()
 
+        notify_monitorings_changed()
+
         flash(_('Monitoring deleted successfuly.'), 'success')
     except Exception as e:
         flash(_('Error deleting this monitoring: %(exception)s', exception=str(e)), 'error')
@@ -86,8 +213,63 @@ def admin_delete(monitoring_id):
     return redirect(url_for('admin'))
 
 
+@app.route('/api/monitorings')
+@auth.login_required(optional=True)
+def api_monitorings():
+    since = request.args.get('since', type=int)
+    monitorings = Monitoring.query.get_for_home(since=since)
+    removals = MonitoringRemoval.get_for_home(since) if since is not None else []
+    shown_ids = {monitoring.id for monitoring in monitorings}
+
+    return jsonify({
+        'cursor': max([monitoring.revision for monitoring in monitorings] + [removal.revision for removal in removals], default=since or 0),
+        'monitorings': [monitoring.to_dict() for monitoring in monitorings],
+        'removed': sorted({removal.monitoring_id for removal in removals if removal.monitoring_id not in shown_ids}) # Shown again since then otherwise
+    })
+
+
+@app.route('/api/reports')
+@auth.login_required(optional=True)
+def api_reports():
+    monitorings = Monitoring.query.get_for_home()
+    reports = get_reports([monitoring.id for monitoring in monitorings], arrow.now())
+
+    return jsonify({
+        'reports': [dict(id=monitoring.id, name=monitoring.name, **reports[monitoring.id]) for monitoring in monitorings]
+    })
+
+
+@app.route('/metrics')
+@auth.login_required
+def metrics():
+    return Response(render_prometheus(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@app.route('/stream')
+@auth.login_required(optional=True)
+def stream():
+    subscriber = broadcaster.subscribe(bool(auth.current_user()))
+
+    if not subscriber: # Too many opened streams: the statuses page polls the API instead
+        abort(503)
+
+    return Response(subscriber.stream(app.config['STREAM_KEEPALIVE_INTERVAL']), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no' # Disable buffering in nginx
+    })
+
+
 @app.route('/rss')
+@auth.login_required(optional=True)
 def rss():
+    return cached_response(
+        ('rss', bool(auth.current_user()), g.CURRENT_LOCALE),
+        render_rss,
+        mimetype='application/rss+xml'
+    )
+
+
+def render_rss():
     monitorings = Monitoring.query.get_for_home()
 
     rss_items = []
@@ -129,4 +311,4 @@ def rss():
         items=rss_items
     )
 
-    return Response(rss.to_xml(encoding='utf-8'), mimetype='application/rss+xml')
+    return rss.to_xml(encoding='utf-8')
@@ -0,0 +1,166 @@
+from concurrent.futures import wait, FIRST_COMPLETED
+from checker import process_result, get_result
+from metrics import metrics, PhaseTimer
+from leases import CLAIM_BATCH_SIZE
+from history import save_checks
+from alerts import TokenBucket
+from models import *
+import heapq
+import click
+import arrow
+import time
+
+
+class Scheduler:
+    """Keep the active monitorings in a min-heap keyed on their next check time, and dispatch them to the check engine
+    as soon as they are due, at most max_per_second (if set) each second.
+
+    The monitorings are reloaded from the database when the admin modifies them (see notify_monitorings_changed()), and
+    every resync_interval seconds in any case.
+
+    Due monitorings are leased before being checked (see LeaseManager), so several schedulers or flask check commands
+    can run at the same time."""
+    def __init__(self, engine, alerts, leases, reload_interval, resync_interval, max_per_second=0):
+        self.engine = engine
+        self.alerts = alerts
+        self.leases = leases
+        self.reload_interval = reload_interval
+        self.resync_interval = resync_interval
+        self.bucket = TokenBucket(max_per_second, max_per_second) if max_per_second else None
+        self.throttled_until = 0
+
+        self.heap = []
+        self.monitorings = {}
+        self.scheduled = {}
+        self.in_flight = {}
+        self.sequence = 0
+        self.loaded_at = None
+        self.signal_mtime = None
+        self.flushed_at = time.monotonic()
+
+    def run(self):
+        while True:
+            if self.must_reload():
+                self.reload()
+
+            self.dispatch_due()
+
+            timeout = self.reload_interval
+
+            if self.heap:
+                timeout = max(0, min(timeout, max(self.heap[0][0], self.throttled_until) - time.time()))
+
+            if self.in_flight:
+                done, _ = wait(self.in_flight, timeout=timeout, return_when=FIRST_COMPLETED)
+
+                timer = PhaseTimer()
+
+                with timer.phase('status_diff'):
+                    results = [result for result in [self.complete(future) for future in done] if result]
+
+                with timer.phase('commit'):
+                    save_checks([monitoring for monitoring, _ in results], [check for _, check in results])
+
+                timer.observe()
+            else:
+                time.sleep(timeout)
+
+            if time.monotonic() - self.flushed_at >= self.reload_interval:
+                metrics.flush(Monitoring.query.get_active_names())
+
+                self.engine.reap_idle_sessions()
+
+                self.flushed_at = time.monotonic()
+
+    def must_reload(self):
+        if not self.loaded_at or time.monotonic() - self.loaded_at >= self.resync_interval:
+            return True
+
+        return get_monitorings_changed_mtime() != self.signal_mtime
+
+    def reload(self):
+        self.signal_mtime = get_monitorings_changed_mtime()
+        self.loaded_at = time.monotonic()
+
+        self.monitorings = {monitoring.id: monitoring for monitoring in Monitoring.query.get_for_checking()}
+        self.heap = []
+        self.scheduled = {}
+
+        for monitoring in self.monitorings.values():
+            if monitoring.id not in self.in_flight.values(): # Will be rescheduled when its check completes
+                self.schedule(monitoring)
+
+        click.echo('{} active monitorings loaded'.format(len(self.monitorings)))
+
+    def schedule(self, monitoring, not_before=None):
+        self.sequence += 1
+        self.scheduled[monitoring.id] = self.sequence
+
+        due_at = monitoring.next_check.float_timestamp
+
+        if not self.leases.is_assigned(monitoring.id): # Belongs to another node: only taken over if this node is late
+            due_at += self.leases.lease_duration
+
+        if not_before:
+            due_at = max(due_at, not_before)
+
+        heapq.heappush(self.heap, (due_at, self.sequence, monitoring.id))
+
+    def dispatch_due(self):
+        now = time.time()
+        due = []
+
+        while self.heap and self.heap[0][0] <= now:
+            if self.scheduled.get(self.heap[0][2]) != self.heap[0][1]: # Outdated heap entry
+                heapq.heappop(self.heap)
+
+                continue
+
+            delay = self.bucket.take() if self.bucket else 0
+
+            if delay: # More than max_per_second checks: the remaining ones are dispatched later
+                self.throttled_until = now + delay
+
+                break
+
+            _, _, monitoring_id = heapq.heappop(self.heap)
+
+            del self.scheduled[monitoring_id]
+
+            due.append(self.monitorings[monitoring_id])
+
+        if not due:
+            return
+
+        claimed = self.leases.claim(due, arrow.now(), due_before=arrow.get(now))
+
+        for monitoring in claimed:
+            future = self.engine.submit_monitoring(monitoring)
+
+            self.in_flight[future] = monitoring.id
+
+        claimed_ids = {monitoring.id for monitoring in claimed}
+
+        self.refresh([monitoring.id for monitoring in due if monitoring.id not in claimed_ids], now + self.reload_interval)
+
+    def refresh(self, ids, not_before):
+        """Reload then reschedule the given monitorings, which were leased or checked by another process."""
+        for i in range(0, len(ids), CLAIM_BATCH_SIZE):
+            for monitoring in Monitoring.query.filter(Monitoring.id.in_(ids[i:i + CLAIM_BATCH_SIZE])).get_for_checking():
+                self.monitorings[monitoring.id] = monitoring
+
+                self.schedule(monitoring, not_before)
+
+    def complete(self, future):
+        """Process the result of a check. Return the (monitoring, check) tuple to save."""
+        monitoring_id = self.in_flight.pop(future)
+        monitoring = self.monitorings.get(monitoring_id)
+
+        if not monitoring: # Deleted or deactivated while it was being checked
+            return None
+
+        check = process_result(monitoring, get_result(future), arrow.now(), self.alerts)
+
+        self.schedule(monitoring)
+
+        return monitoring, check
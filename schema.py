@@ -0,0 +1,98 @@
+from sqlalchemy import inspect, literal, text
+from serverpatrol import db
+from models import *
+
+
+def get_column_default(column):
+    """SQL literal of the Python-side default of the given column, if it is a constant or doesn't depend on the row."""
+    if column.default is None or not (column.default.is_scalar or column.default.is_callable):
+        return None
+
+    value = column.default.arg(None) if column.default.is_callable else column.default.arg
+
+    if value is None:
+        return None
+
+    return str(literal(value, column.type).compile(dialect=db.engine.dialect, compile_kwargs={'literal_binds': True}))
+
+
+def get_add_column_statement(column):
+    """ALTER TABLE statement adding the given column to its existing table. The existing rows get the default value of
+    the column, which NOT NULL columns require."""
+    statement = 'ALTER TABLE {} ADD COLUMN {} {}'.format(
+        column.table.name,
+        column.name,
+        column.type.compile(dialect=db.engine.dialect)
+    )
+
+    default = get_column_default(column)
+
+    if default is not None:
+        statement += ' DEFAULT ' + default
+
+    if not column.nullable:
+        statement += ' NOT NULL'
+
+    return statement
+
+
+def get_missing_columns():
+    """Columns of the models missing from the existing tables."""
+    inspector = inspect(db.engine)
+    tables = set(inspector.get_table_names())
+    missing = []
+
+    for table in db.metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+
+        missing.extend(column for column in table.columns if column.name not in existing)
+
+    return missing
+
+
+def get_missing_indexes():
+    inspector = inspect(db.engine)
+    missing = []
+
+    for table in db.metadata.sorted_tables:
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+
+        missing.extend(index for index in table.indexes if index.name not in existing)
+
+    return missing
+
+
+def upgrade_database(echo):
+    """Bring the tables of a database created by a former version up to date with the models, without losing any data:
+    create the missing tables, columns and indexes, then fill the new columns which can't just be given a default
+    value. Can be run several times. Progress is reported through echo()."""
+    missing_columns = get_missing_columns()
+
+    echo('Creating the missing tables')
+
+    db.create_all()
+
+    for column in missing_columns:
+        echo('Adding column {}.{}'.format(column.table.name, column.name))
+
+        db.session.execute(text(get_add_column_statement(column)))
+
+    db.session.commit()
+
+    for index in get_missing_indexes():
+        echo('Creating index {}'.format(index.name))
+
+        index.create(db.engine)
+
+    monitorings = Monitoring.query.filter(Monitoring.next_check_at == None).all()
+
+    if monitorings:
+        echo('Scheduling the next check of {} monitorings'.format(len(monitorings)))
+
+        for monitoring in monitorings:
+            monitoring.next_check_at = monitoring.next_check
+
+        db.session.commit()
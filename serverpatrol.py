@@ -1,23 +1,79 @@
 from logging.handlers import RotatingFileHandler
 from flask_httpauth import HTTPBasicAuth
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.engine import Engine
+from flask.cli import AppGroup
 from flask_babel import Babel
-from flask_mail import Mail
-from flask import Flask
+from sqlalchemy import event
+from flask import Flask, g
 import logging
 import arrow
 
 
 # -----------------------------------------------------------
 # Boot
+#
+# This module only sets up what both the web app and the flask commands need. The web app's entry point is web.py
+# (imported by uwsgi.py and local.py), the flask commands' one is this module.
+
+
+class CommandsGroup(AppGroup):
+    """The flask commands. Their modules, and the checker's dependencies along with them, are only imported when a
+    command is looked up, so the web app never loads them."""
+    def get_command(self, ctx, name):
+        import commands
+
+        if name == 'benchmark':
+            import benchmarks
+
+        return super().get_command(ctx, name)
+
+    def list_commands(self, ctx):
+        import commands
+        import benchmarks
+
+        return super().list_commands(ctx)
 
 
 app = Flask(__name__, static_url_path='')
+app.cli = CommandsGroup(app.name)
 app.config.from_pyfile('config.py')
 
 if not app.config['TITLE']:
     app.config['TITLE'] = 'Server Patrol'
 
+app.config.setdefault('CHECKS_MAX_WORKERS', 20)
+app.config.setdefault('CHECKS_MAX_WORKERS_PER_HOST', 2)
+app.config.setdefault('CHECKS_MEASURE_TIMINGS', False)
+app.config.setdefault('CHECKS_RETRY_DELAY', 1)
+app.config.setdefault('CHECKS_JITTER', 5)
+app.config.setdefault('CHECKS_MAX_PER_SECOND', 0)
+app.config.setdefault('HTTP_POOL_MAX_HOSTS', 100)
+app.config.setdefault('HTTP_POOL_IDLE_TIMEOUT', 60)
+app.config.setdefault('HTTP_BODY_MAX_BYTES', 1024 * 1024)
+app.config.setdefault('DNS_CACHE_TTL', 60)
+app.config.setdefault('DNS_CACHE_NEGATIVE_TTL', 10)
+app.config.setdefault('PATROL_RELOAD_INTERVAL', 5)
+app.config.setdefault('PATROL_RESYNC_INTERVAL', 300)
+app.config.setdefault('CHECKS_RETENTION_DAYS', 7)
+app.config.setdefault('HOURLY_CHECK_ROLLUPS_RETENTION_DAYS', 90)
+app.config.setdefault('CHECKS_COMMIT_BATCH_SIZE', 500)
+app.config.setdefault('CHECKS_LEASE_DURATION', 300)
+app.config.setdefault('CHECKS_NODES', [])
+app.config.setdefault('CHECKS_NODE', None)
+app.config.setdefault('SQLITE_WAL', False)
+app.config.setdefault('STATUS_PAGE_CACHE_MAX_AGE', 60)
+app.config.setdefault('MONITORINGS_PER_PAGE', 50)
+app.config.setdefault('STREAM_POLL_INTERVAL', 2)
+app.config.setdefault('STREAM_KEEPALIVE_INTERVAL', 15)
+app.config.setdefault('STREAM_MAX_SUBSCRIBERS', None)
+app.config.setdefault('STREAM_FALLBACK_POLL_INTERVAL', 30)
+app.config.setdefault('ALERTS_MAX_RETRIES', 3)
+app.config.setdefault('ALERTS_RETRY_DELAY', 10)
+app.config.setdefault('ALERTS_DIGEST_WINDOW', 30)
+app.config.setdefault('SMS_PER_SECOND', 1)
+app.config.setdefault('SMS_BURST', 1)
+
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///storage/data/db.sqlite'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['MAIL_DEBUG'] = False
@@ -31,7 +87,27 @@ app.config['LANGUAGES'] = {
 db = SQLAlchemy(app)
 babel = Babel(app)
 auth = HTTPBasicAuth()
-mail = Mail(app)
+
+
+@babel.localeselector
+def get_app_locale():
+    if not hasattr(g, 'CURRENT_LOCALE'):
+        return app.config['DEFAULT_LANGUAGE']
+    else:
+        return g.CURRENT_LOCALE
+
+
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA foreign_keys=ON') # Needed for the checks to be deleted along their monitoring
+
+    if app.config['SQLITE_WAL']: # Readers don't block writers and vice-versa
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+
+    cursor.close()
+
 
 handler = RotatingFileHandler('storage/logs/errors.log', maxBytes=10000000, backupCount=2)
 handler.setLevel(logging.WARNING)
@@ -39,6 +115,13 @@ formatter = logging.Formatter(fmt='%(asctime)s - %(levelname)s - %(message)s', d
 handler.setFormatter(formatter)
 app.logger.addHandler(handler)
 
+ticks_handler = RotatingFileHandler('storage/logs/ticks.log', maxBytes=10000000, backupCount=2, delay=True)
+ticks_handler.setFormatter(logging.Formatter(fmt='%(message)s'))
+ticks_logger = logging.getLogger('serverpatrol.ticks')
+ticks_logger.setLevel(logging.INFO)
+ticks_logger.propagate = False
+ticks_logger.addHandler(ticks_handler)
+
 app.jinja_env.globals.update(arrow=arrow)
 
 
@@ -46,7 +129,4 @@ app.jinja_env.globals.update(arrow=arrow)
 # After-init imports
 
 
-import routes
 import models
-import commands
-import hooks
@@ -0,0 +1,43 @@
+import math
+
+
+class DurationSketch:
+    """Mergeable streaming quantile sketch of durations, in milliseconds (a DDSketch).
+
+    Values are counted in buckets whose bounds grow exponentially, so any quantile is estimated with a relative error of
+    at most RELATIVE_ACCURACY whatever the number of values, using a few hundred buckets at most. Two sketches are
+    merged by adding their bucket counts, which gives the same result as if all the values were added to a single one."""
+    RELATIVE_ACCURACY = 0.01
+    GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+
+    __slots__ = ('buckets', 'count')
+
+    def __init__(self, buckets=None):
+        self.buckets = {int(index): count for index, count in (buckets or {}).items()} # Keys are strings when decoded from JSON
+        self.count = sum(self.buckets.values())
+
+    def add(self, value):
+        index = math.ceil(math.log(max(value, 1), self.GAMMA))
+
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+
+    def merge(self, other):
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+
+        self.count += other.count
+
+    def quantile(self, q):
+        """Estimated value at the given quantile (between 0 and 1), or None if the sketch is empty."""
+        if not self.count:
+            return None
+
+        rank = q * (self.count - 1)
+        cumulated = 0
+
+        for index in sorted(self.buckets):
+            cumulated += self.buckets[index]
+
+            if cumulated > rank:
+                return round(2 * self.GAMMA ** index / (self.GAMMA + 1))
@@ -0,0 +1,93 @@
+/**
+ * Update the status chips and the down reasons of the statuses page in place as the status of the monitorings
+ * change, using the Server-Sent Events pushed by the /stream route. When the stream isn't available (too many opened
+ * streams on the server), the changes are polled from the API instead.
+ */
+(function() {
+    var script = document.currentScript;
+
+    if (!script || !window.EventSource && !window.fetch) {
+        return;
+    }
+
+    var locale = document.documentElement.lang || undefined;
+
+    var STATUS_ICONS = {UP: 'check', DOWN: 'times', UNKNOWN: 'question'}; // The API doesn't return them
+
+    function formatDate(value) {
+        var date = new Date(value);
+        var formatted = date.toLocaleString(locale, {dateStyle: 'short', timeStyle: 'short'});
+
+        if (!window.Intl || !Intl.RelativeTimeFormat) {
+            return formatted;
+        }
+
+        var minutes = Math.round((date - Date.now()) / 60000);
+        var relative = new Intl.RelativeTimeFormat(locale, {numeric: 'auto'});
+
+        if (Math.abs(minutes) < 60) {
+            return formatted + ' (' + relative.format(minutes, 'minute') + ')';
+        }
+
+        if (Math.abs(minutes) < 60 * 24) {
+            return formatted + ' (' + relative.format(Math.round(minutes / 60), 'hour') + ')';
+        }
+
+        return formatted + ' (' + relative.format(Math.round(minutes / 60 / 24), 'day') + ')';
+    }
+
+    function update(monitoring) {
+        var element = document.querySelector('.monitoring[data-id="' + monitoring.id + '"]');
+
+        if (!element) {
+            return;
+        }
+
+        var chip = element.querySelector('.status-chip');
+
+        chip.className = 'status-chip ' + monitoring.status;
+        chip.querySelector('i').className = 'fa fa-' + (monitoring.status_icon || STATUS_ICONS[monitoring.status]);
+
+        var reason = element.querySelector('.last-down-reason');
+        var isDown = monitoring.status == 'DOWN';
+
+        reason.hidden = !isDown;
+        reason.querySelector('.down-since').textContent = isDown && monitoring.last_status_change_at ? formatDate(monitoring.last_status_change_at) : '';
+        reason.querySelector('.down-reason').textContent = isDown ? monitoring.last_down_reason || '' : '';
+    }
+
+    function poll(since) {
+        var url = script.getAttribute('data-api-url') + (since !== undefined ? '?since=' + since : '');
+
+        fetch(url, {credentials: 'same-origin'}).then(function(response) {
+            return response.ok ? response.json() : null;
+        }).then(function(data) {
+            if (data) {
+                data.monitorings.forEach(update);
+
+                since = data.cursor;
+            }
+        }).catch(function() {}).then(function() {
+            setTimeout(function() { poll(since); }, script.getAttribute('data-poll-interval') * 1000);
+        });
+    }
+
+    if (!window.EventSource) {
+        poll();
+
+        return;
+    }
+
+    var source = new EventSource(script.getAttribute('data-stream-url'));
+
+    source.addEventListener('status', function(e) {
+        update(JSON.parse(e.data));
+    });
+
+    source.addEventListener('error', function() {
+        // Closed for good (as opposed to reconnecting) when the server refuses the stream
+        if (source.readyState == EventSource.CLOSED && window.fetch) {
+            poll();
+        }
+    });
+})();
@@ -0,0 +1,370 @@
+from urllib3.exceptions import NameResolutionError, NewConnectionError, ConnectTimeoutError
+from urllib3.util.connection import allowed_gai_family
+from http.cookiejar import DefaultCookiePolicy
+from requests.adapters import HTTPAdapter
+from collections import OrderedDict
+from urllib.parse import urlsplit
+from metrics import metrics
+import urllib3.connectionpool
+import urllib3.connection
+import threading
+import requests
+import socket
+import time
+
+
+DNS_CACHE_MAX_ENTRIES = 10000
+
+# Resolution errors meaning the host name doesn't exist (or has no address), which are worth caching. Temporary
+# failures aren't, so a retried check resolves the host name again
+NEGATIVE_CACHE_ERRORS = {getattr(socket, name) for name in ('EAI_NONAME', 'EAI_NODATA') if hasattr(socket, name)}
+
+
+timings = threading.local() # Timings of the request being performed by the current thread
+
+
+def reset_timings():
+    timings.dns = 0.0
+    timings.connect = 0.0
+    timings.tls = 0.0
+
+
+def get_dns_duration():
+    """Time spent resolving the host name (0 if it was in the DNS cache)."""
+    return getattr(timings, 'dns', 0.0)
+
+
+def get_connect_duration():
+    """Time spent establishing the TCP connection."""
+    return getattr(timings, 'connect', 0.0)
+
+
+def get_tls_duration():
+    return getattr(timings, 'tls', 0.0)
+
+
+class DnsLookup:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None # Addresses or exception
+
+
+class DnsCache:
+    """Addresses of the host names resolved by the connections of the checks, shared by all of them so a host name is
+    resolved at most once every ttl seconds whatever the number of monitorings targeting it. Host names which don't
+    exist are cached as well, for negative_ttl seconds. A ttl of 0 disables the cache.
+
+    getaddrinfo() doesn't tell the TTL of the DNS records, so it's the same for every host name. Concurrent lookups of
+    the same host name share the result of the first one instead of querying the resolver again."""
+    def __init__(self, ttl=0, negative_ttl=0):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+
+        self.lock = threading.Lock()
+        self.entries = OrderedDict() # (host, port, family) => (expires at, addresses or socket.gaierror)
+        self.lookups = {} # (host, port, family) => DnsLookup in progress
+
+    def configure(self, ttl, negative_ttl):
+        with self.lock:
+            self.ttl = ttl
+            self.negative_ttl = negative_ttl
+
+            self.entries.clear()
+
+    def resolve(self, host, port, family=socket.AF_UNSPEC):
+        """Return the IP addresses of a host name, in the order returned by getaddrinfo(). Raise socket.gaierror if it
+        can't be resolved."""
+        if not self.ttl:
+            return self._resolve(host, port, family)
+
+        key = (host, port, family)
+        lookup = None
+        started = False
+
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry and entry[0] > time.monotonic():
+                result = entry[1]
+
+                metrics.inc('serverpatrol_dns_lookups_total', result='hit' if isinstance(result, list) else 'negative_hit')
+            else:
+                lookup = self.lookups.get(key)
+
+                if not lookup:
+                    lookup = self.lookups[key] = DnsLookup()
+                    started = True
+
+        if started:
+            ttl = 0
+
+            try:
+                lookup.result = self._resolve(host, port, family)
+                ttl = self.ttl
+            except socket.gaierror as e:
+                lookup.result = e
+                ttl = self.negative_ttl if e.errno in NEGATIVE_CACHE_ERRORS else 0
+            except Exception as e:
+                lookup.result = e
+            finally:
+                self._store(key, lookup, ttl)
+
+        if lookup:
+            lookup.done.wait() # Started by another thread if not by this one
+
+            result = lookup.result
+
+        if isinstance(result, list):
+            return result
+        elif isinstance(result, socket.gaierror):
+            raise socket.gaierror(*result.args) # Not the cached instance, whose traceback would grow
+
+        raise result
+
+    def _resolve(self, host, port, family):
+        metrics.inc('serverpatrol_dns_lookups_total', result='miss')
+
+        addresses = []
+
+        for _, _, _, _, address in socket.getaddrinfo(host, port, family, socket.SOCK_STREAM):
+            if address[0] not in addresses:
+                addresses.append(address[0])
+
+        return addresses
+
+    def _store(self, key, lookup, ttl):
+        with self.lock:
+            del self.lookups[key]
+
+            if ttl:
+                self.entries.pop(key, None)
+                self.entries[key] = (time.monotonic() + ttl, lookup.result)
+
+                while len(self.entries) > DNS_CACHE_MAX_ENTRIES: # The oldest entries are the first to expire
+                    self.entries.popitem(last=False)
+
+        lookup.done.set()
+
+
+dns_cache = DnsCache() # Shared by all the connections of the process (see CheckEngine)
+
+
+class CachedDnsConnectionMixin:
+    """Resolve the host name using dns_cache, then try to connect to each of its addresses in turn like urllib3 does.
+    The host name is still the one used for the Host header, SNI and certificate verification."""
+    def _new_conn(self):
+        start = time.perf_counter()
+
+        try:
+            addresses = dns_cache.resolve(self._dns_host, self.port, allowed_gai_family())
+        except socket.gaierror as e:
+            raise NameResolutionError(self.host, self, e) from e
+        finally:
+            timings.dns = get_dns_duration() + time.perf_counter() - start
+
+        dns_host = self._dns_host
+        error = None
+
+        try:
+            for address in addresses:
+                self._dns_host = address
+
+                try:
+                    return super()._new_conn()
+                except (NewConnectionError, ConnectTimeoutError) as e:
+                    error = e
+        finally:
+            self._dns_host = dns_host
+
+        raise error
+
+
+class TimedConnectionMixin:
+    def _new_conn(self):
+        start = time.perf_counter()
+        dns_duration = get_dns_duration()
+
+        try:
+            return super()._new_conn()
+        finally:
+            timings.connect = get_connect_duration() + time.perf_counter() - start - (get_dns_duration() - dns_duration)
+
+    def connect(self):
+        start = time.perf_counter()
+        dns_duration = get_dns_duration()
+        connect_duration = get_connect_duration()
+
+        try:
+            super().connect()
+        finally: # Whatever isn't spent in _new_conn() is spent in the TLS handshake
+            timings.tls = get_tls_duration() + time.perf_counter() - start - (get_dns_duration() - dns_duration) - (get_connect_duration() - connect_duration)
+
+
+class CachedDnsHTTPConnection(CachedDnsConnectionMixin, urllib3.connection.HTTPConnection):
+    pass
+
+
+class CachedDnsHTTPSConnection(CachedDnsConnectionMixin, urllib3.connection.HTTPSConnection):
+    pass
+
+
+class TimedHTTPConnection(TimedConnectionMixin, CachedDnsHTTPConnection):
+    pass
+
+
+class TimedHTTPSConnection(TimedConnectionMixin, CachedDnsHTTPSConnection):
+    pass
+
+
+class CachedDnsHTTPConnectionPool(urllib3.connectionpool.HTTPConnectionPool):
+    ConnectionCls = CachedDnsHTTPConnection
+
+
+class CachedDnsHTTPSConnectionPool(urllib3.connectionpool.HTTPSConnectionPool):
+    ConnectionCls = CachedDnsHTTPSConnection
+
+
+class TimedHTTPConnectionPool(urllib3.connectionpool.HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(urllib3.connectionpool.HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+class CheckHTTPAdapter(HTTPAdapter):
+    def __init__(self, measure_timings, *args, **kwargs):
+        self.measure_timings = measure_timings
+
+        super().__init__(*args, **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+
+        if self.measure_timings:
+            self.poolmanager.pool_classes_by_scheme = {
+                'http': TimedHTTPConnectionPool,
+                'https': TimedHTTPSConnectionPool
+            }
+        else:
+            self.poolmanager.pool_classes_by_scheme = {
+                'http': CachedDnsHTTPConnectionPool,
+                'https': CachedDnsHTTPSConnectionPool
+            }
+
+
+class SessionPool:
+    """Keep-alive requests sessions, one per (scheme, host, verify_https_cert), shared by the engine's worker threads.
+
+    At most max_sessions sessions are kept (the least recently used one is evicted first), and sessions unused for more
+    than idle_timeout seconds are evicted, when a session is requested or reap() is called. Sessions are checked out by
+    get() until given back to release(): evicting a session checked out by another thread only closes it once it is
+    released."""
+    def __init__(self, max_sessions, idle_timeout, max_connections_per_session, measure_timings):
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.max_connections_per_session = max_connections_per_session
+        self.measure_timings = measure_timings
+
+        self.lock = threading.Lock()
+        self.sessions = OrderedDict() # Key => (session, last used at), least recently used first
+        self.keys = {} # Session => key, for the sessions checked out
+        self.users = {} # Session => number of threads which checked it out
+        self.evicted = set() # Sessions evicted while checked out, closed once released
+
+    def get(self, url, verify_https_cert):
+        """Check out the session to use for the given URL. It must be given back to release()."""
+        url = urlsplit(url)
+        key = (url.scheme, url.netloc, verify_https_cert)
+        now = time.monotonic()
+
+        with self.lock:
+            to_close = self._evict(now, keep=key)
+
+            if key in self.sessions:
+                session = self.sessions.pop(key)[0]
+            else:
+                session = self.create_session()
+
+            self.sessions[key] = (session, now)
+            self.keys[session] = key
+            self.users[session] = self.users.get(session, 0) + 1
+
+        for session_to_close in to_close:
+            session_to_close.close()
+
+        return session
+
+    def release(self, session):
+        with self.lock:
+            self.users[session] -= 1
+
+            if self.users[session]:
+                return
+
+            del self.users[session]
+
+            key = self.keys.pop(session)
+
+            if session in self.evicted:
+                self.evicted.remove(session)
+            else:
+                self.sessions[key] = (session, time.monotonic())
+                self.sessions.move_to_end(key)
+
+                return
+
+        session.close()
+
+    def reap(self):
+        """Evict the sessions unused for more than idle_timeout seconds."""
+        with self.lock:
+            to_close = self._evict(time.monotonic())
+
+        for session in to_close:
+            session.close()
+
+    def _evict(self, now, keep=None):
+        """Evict the least recently used sessions while they are idle or there are too many of them, except the one of
+        the given key. Return the ones to close now, that is which aren't checked out. Must be called holding the lock."""
+        to_close = []
+
+        while self.sessions:
+            oldest_key, (oldest_session, last_used_at) = next(iter(self.sessions.items()))
+
+            if now - last_used_at < self.idle_timeout and len(self.sessions) < self.max_sessions:
+                break
+
+            if oldest_key == keep:
+                break
+
+            del self.sessions[oldest_key]
+
+            if oldest_session in self.users:
+                self.evicted.add(oldest_session)
+            else:
+                to_close.append(oldest_session)
+
+        return to_close
+
+    def create_session(self):
+        session = requests.Session()
+
+        session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[])) # Checks must not influence each other
+
+        adapter = CheckHTTPAdapter(self.measure_timings, pool_connections=1, pool_maxsize=self.max_connections_per_session)
+
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+
+        return session
+
+    def close(self):
+        with self.lock:
+            sessions = [session for session, _ in self.sessions.values()] + list(self.evicted)
+
+            self.sessions.clear()
+            self.evicted.clear()
+
+        for session in sessions:
+            session.close()
@@ -1 +1 @@
-from serverpatrol import app
+from web import app
@@ -0,0 +1,3 @@
+from serverpatrol import app
+import routes
+import hooks